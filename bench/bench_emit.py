@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+'''Benchmark YAML emission of rendered resources, per-resource yaml.dump versus the emission layer'''
+
+import sys, os
+import io
+import argparse
+import time
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import helm2yaml
+import synthetic
+
+def emit_file_legacy(fh, res):
+    for r in res:
+        print(yaml.dump(r), file=fh)
+        print('---', file=fh)
+
+def emit_stdout_legacy(fh, res):
+    print('apiVersion: config.kubernetes.io/v1', file=fh)
+    print('kind: ResourceList', file=fh)
+    print(yaml.dump({'items': res}), file=fh)
+
+def timeit(fn, res, rounds):
+    best = None
+    for _ in range(rounds):
+        fh = io.StringIO()
+        t0 = time.perf_counter()
+        fn(fh, res)
+        dt = time.perf_counter()-t0
+        best = dt if best is None else min(best, dt)
+    return best, fh.getvalue()
+
+def main():
+    parser = argparse.ArgumentParser(description='YAML emission benchmark')
+    parser.add_argument('-n', dest='count', default=5000, type=int, help='Number of resources')
+    parser.add_argument('-r', dest='rounds', default=3, type=int, help='Rounds, best time is reported')
+    args = parser.parse_args()
+
+    res = synthetic.resources(args.count, namespace='bench')
+    print('libyaml: {}'.format(yaml.__with_libyaml__))
+    for name, legacy, new in [('file', emit_file_legacy, helm2yaml.emit_resources),
+                              ('stdout', emit_stdout_legacy, helm2yaml.emit_resource_list)]:
+        t_old, out_old = timeit(legacy, res, args.rounds)
+        t_new, out_new = timeit(new, res, args.rounds)
+        print('{:7s} {} resources: legacy {:.3f}s, emit {:.3f}s, speedup {:.1f}x, identical output: {}'.format(
+            name, len(res), t_old, t_new, t_old/t_new, out_old==out_new))
+
+if __name__ == "__main__":
+   sys.exit(main())
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+'''Benchmark the images subcommand scanning a render path of many files, serial versus parallel'''
+
+import sys, os
+import argparse
+import shutil
+import subprocess
+import tempfile
+import time
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(BENCH, '..')
+import synthetic
+
+def main():
+    parser = argparse.ArgumentParser(description='Image inventory benchmark')
+    parser.add_argument('-n', dest='files', default=500, type=int, help='Number of rendered files')
+    parser.add_argument('--resources', default=50, type=int, help='Resources per file')
+    parser.add_argument('-j', dest='jobs', default=[], type=int, action='append',
+                        help='Concurrency to measure, default 1, 2, 4 and the number of CPUs')
+    args = parser.parse_args()
+
+    render_path = tempfile.mkdtemp()
+    try:
+        text = synthetic.chart_template('bench', 'bench', args.resources)
+        for i in range(args.files):
+            with open(os.path.join(render_path, 'release-{}.yaml'.format(i)), 'w') as fh:
+                fh.write(text)
+        print('{} files of {} resources'.format(args.files, args.resources))
+        print('{:>5s} {:>10s} {:>10s}'.format('Jobs', 'Time [s]', 'Files/s'))
+        for jobs in sorted(set(args.jobs or [1, 2, 4, os.cpu_count()])):
+            t0 = time.perf_counter()
+            subprocess.run([sys.executable, os.path.join(ROOT, 'helm2yaml.py'), '-l', 'WARNING', '-j', str(jobs),
+                            '--render-path', render_path, 'images'], check=True, stdout=subprocess.DEVNULL)
+            dt = time.perf_counter()-t0
+            print('{:5d} {:10.3f} {:10.0f}'.format(jobs, dt, args.files/dt))
+    finally:
+        shutil.rmtree(render_path, ignore_errors=True)
+
+if __name__ == "__main__":
+   sys.exit(main())
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+'''Benchmark k8envsubst.py throughput and peak memory, whole input versus --stream'''
+
+import sys, os
+import argparse
+import base64
+import subprocess
+import tempfile
+import time
+import yaml
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(BENCH, '..')
+import synthetic
+
+def bundle(count):
+    '''Return a manifest bundle with variable references in ConfigMaps and Secret data'''
+    dumper = getattr(yaml, 'CDumper', yaml.Dumper)
+    out = []
+    for r in synthetic.chart_resources('bench', 'bench', count):
+        if r['kind'] == 'Secret':
+            r['data']['password'] = base64.b64encode(b'password-${BENCH_PASSWORD}').decode('UTF-8')
+        if r['kind'] == 'ConfigMap':
+            r['data']['host'] = '${BENCH_HOST}:8080'
+        out.append('# Source: bench/templates/{}.yaml\n'.format(r['kind'].lower()))
+        out.append(yaml.dump(r, Dumper=dumper))
+        out.append('---\n')
+    return ''.join(out)
+
+def run(cmd, fname, env):
+    '''Return wall time, peak RSS in MiB and output of running cmd with fname as stdin'''
+    wrapper = ('import resource, subprocess, sys\n'
+               'out = subprocess.run(sys.argv[1:], check=True, stdout=subprocess.PIPE).stdout\n'
+               'sys.stderr.write(str(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss))\n'
+               'sys.stdout.buffer.write(out)\n')
+    with open(fname, 'rb') as fh:
+        t0 = time.perf_counter()
+        proc = subprocess.run([sys.executable, '-c', wrapper] + cmd, stdin=fh, env=env, check=True,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        dt = time.perf_counter()-t0
+    return dt, int(proc.stderr)/1024.0, proc.stdout.decode('UTF-8')
+
+def main():
+    parser = argparse.ArgumentParser(description='k8envsubst.py benchmark')
+    parser.add_argument('-n', dest='count', default=5000, type=int, help='Number of resources')
+    args = parser.parse_args()
+
+    tmp = tempfile.NamedTemporaryFile('w', suffix='.yaml', delete=False)
+    with tmp:
+        tmp.write(bundle(args.count))
+    size = os.path.getsize(tmp.name)/1024.0/1024
+    env = dict(os.environ, BENCH_PASSWORD='s3cret', BENCH_HOST='db.example.com')
+    k8envsubst = os.path.join(ROOT, 'k8envsubst.py')
+    try:
+        print('Bundle: {} resources, {:.1f} MiB'.format(args.count, size))
+        print('{:10s} {:>10s} {:>10s} {:>10s}'.format('Mode', 'Time [s]', 'MiB/s', 'Peak [MiB]'))
+        outputs = {}
+        for mode, opts in [('whole', []), ('stream', ['--stream'])]:
+            dt, peak, outputs[mode] = run([sys.executable, k8envsubst] + opts, tmp.name, env)
+            print('{:10s} {:10.3f} {:10.1f} {:10.1f}'.format(mode, dt, size/dt, peak))
+    finally:
+        os.remove(tmp.name)
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    whole = [r for r in yaml.load_all(outputs['whole'], Loader=loader) if r]
+    stream = [r for r in yaml.load_all(outputs['stream'], Loader=loader) if r]
+    print('Identical resources: {}'.format(whole == stream))
+
+if __name__ == "__main__":
+   sys.exit(main())
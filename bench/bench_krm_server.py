@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+'''Benchmark KRM function latency, a cold helm2yaml.py process per call versus krmclient.py and a warm krm-server'''
+
+import sys, os
+import argparse
+import glob
+import shlex
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+EXAMPLES = os.path.join(ROOT, 'examples')
+
+def run(cmd, fname):
+    with open(fname, 'rb') as fh:
+        t0 = time.perf_counter()
+        subprocess.run(cmd, stdin=fh, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=EXAMPLES, check=True)
+        return time.perf_counter()-t0
+
+def wait_for(path, timeout=10):
+    t0 = time.time()
+    while not os.path.exists(path):
+        if time.time()-t0 > timeout:
+            raise TimeoutError("Server socket '{}' not created".format(path))
+        time.sleep(0.05)
+
+def main():
+    parser = argparse.ArgumentParser(description='KRM function server benchmark')
+    parser.add_argument('-b', dest='helm_bin', default='helm', help='Helm binary, see bench/fakehelm.py for an offline stand-in')
+    parser.add_argument('-n', dest='rounds', default=5, type=int, help='Calls per example')
+    parser.add_argument('examples', nargs='*', help='KRM spec files, default all examples/krm-*.yaml')
+    args = parser.parse_args()
+    # helm2yaml runs with cwd examples/, a helm binary given by path must not be relative
+    helm_bin = shlex.split(args.helm_bin)
+    if os.sep in helm_bin[0]:
+        args.helm_bin = shlex.join([os.path.abspath(helm_bin[0])] + helm_bin[1:])
+
+    examples = args.examples or sorted(glob.glob(os.path.join(EXAMPLES, 'krm-*.yaml')))
+    tmpdir = tempfile.mkdtemp()
+    sockpath = os.path.join(tmpdir, 'helm2yaml.sock')
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, 'helm2yaml.py'), '-l', 'WARNING', '-b', args.helm_bin,
+                               'krm-server', '--socket', sockpath], cwd=EXAMPLES)
+    try:
+        wait_for(sockpath)
+        cold_cmd = [sys.executable, os.path.join(ROOT, 'helm2yaml.py'), '-l', 'WARNING', '-b', args.helm_bin, '-o', 'stdout', 'krm', '-f', '-']
+        warm_cmd = [sys.executable, os.path.join(ROOT, 'krmclient.py'), '--socket', sockpath]
+        print('{:40s} {:>10s} {:>10s}'.format('Example', 'Cold [ms]', 'Warm [ms]'))
+        for fname in examples:
+            try:
+                run(warm_cmd, fname)    # First request fetches chart
+            except subprocess.CalledProcessError:
+                print('{:40s} failed'.format(os.path.basename(fname)))
+                continue
+            cold = [run(cold_cmd, fname) for _ in range(args.rounds)]
+            warm = [run(warm_cmd, fname) for _ in range(args.rounds)]
+            print('{:40s} {:10.1f} {:10.1f}'.format(os.path.basename(fname), statistics.median(cold)*1000, statistics.median(warm)*1000))
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+if __name__ == "__main__":
+   sys.exit(main())
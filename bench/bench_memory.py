@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+'''Check that peak memory of helm2yaml.py does not grow with the number of releases rendered
+
+Renders an increasing number of synthetic releases, each with the same
+template output, and reports the peak RSS of each run. Runs offline with
+bench/fakehelm.py as helm binary. Exits non-zero if, at any release count,
+peak RSS exceeds that of the fewest releases by more than --max-growth bytes
+per resource of each additional release plus --slack MiB of allocator noise.
+Neither the parsed resources nor the index entries of completed releases are
+kept in memory, so peak RSS should be flat once the fewest releases fill the
+concurrent renders.
+'''
+
+import sys, os
+import argparse
+import shutil
+import tempfile
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(BENCH, '..')
+import runner
+import synthetic
+
+def write_spec(fname, releases):
+    with open(fname, 'w') as fh:
+        fh.write('helmCharts:\n')
+        for n in range(releases):
+            fh.write('- name: bench\n  repo: https://charts.example.com\n  version: 1.0.0\n'
+                     '  releaseName: rel{}\n  namespace: ns{}\n'.format(n, n))
+
+def main():
+    parser = argparse.ArgumentParser(description='Peak memory versus number of releases')
+    parser.add_argument('-n', dest='count', default=1000, type=int, help='Number of resources per release')
+    parser.add_argument('--releases', default=[6, 12, 36], type=int, nargs='+',
+                        help='Release counts to run, the fewest should be above twice the number of concurrent releases')
+    parser.add_argument('-j', dest='jobs', default=2, type=int, help='Concurrent releases')
+    parser.add_argument('--max-growth', default=64, type=int,
+                        help='Allowed growth of peak RSS in bytes per resource of each additional release')
+    parser.add_argument('--slack', default=1.5, type=float, help='Allowed growth of peak RSS in MiB, for allocator noise')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    failures = []
+    try:
+        tmpl = os.path.join(tmpdir, 'template.yaml')
+        with open(tmpl, 'w') as fh:
+            fh.write(synthetic.chart_template('bench', 'bench', args.count))
+        env = dict(os.environ, FAKEHELM_TEMPLATE=tmpl)
+        base = [sys.executable, os.path.join(ROOT, 'helm2yaml.py'), '-l', 'ERROR', '-b', os.path.join(BENCH, 'fakehelm.py'),
+                '--no-repo-index', '--hook-filter', 'test', '--auto-api-upgrade', '-j', str(args.jobs)]
+        runs = [('file', ['--render-path', os.path.join(tmpdir, 'rendered')]),
+                ('stdout', ['-o', 'stdout']),
+                ('list-images', ['--list-images'])]
+        print('Release output: {} resources, {:.1f} MiB'.format(args.count, os.path.getsize(tmpl)/1024.0/1024))
+        print('{:12s} {:>9s} {:>10s} {:>11s} {:>14s}'.format('Mode', 'Releases', 'Time [s]', 'Peak [MiB]', 'Bytes/resource'))
+        for name, opts in runs:
+            peaks = []
+            counts = sorted(args.releases)
+            for releases in counts:
+                spec = os.path.join(tmpdir, 'spec{}.yaml'.format(releases))
+                write_spec(spec, releases)
+                shutil.rmtree(os.path.join(tmpdir, 'rendered'), ignore_errors=True)
+                dt, peak, _ = runner.run_process(base + opts + ['krm', '-f', spec], env)
+                peaks.append(peak)
+                growth = 0
+                if releases > counts[0]:
+                    resources = (releases-counts[0])*args.count
+                    growth = (peak-peaks[0])*1024*1024/resources
+                    if peak-peaks[0] > args.slack + args.max_growth*resources/1024.0/1024:
+                        failures.append('{}: peak RSS grows {:.0f} bytes per resource of each additional release, '
+                                        'at {} releases'.format(name, growth, releases))
+                print('{:12s} {:9d} {:10.3f} {:11.1f} {:14.0f}'.format(name, releases, dt, peak, growth))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    for f in failures:
+        print('FAILED: {}'.format(f))
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+   sys.exit(main())
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+'''Benchmark the resource pipeline stages and helm2yaml.py end to end on synthetic chart output, time and peak memory
+
+Runs offline, end to end runs use bench/fakehelm.py as helm binary.
+Results can be saved with --json and compared against later runs with
+--baseline.
+'''
+
+import sys, os
+import io
+import argparse
+import itertools
+import copy
+import json
+import logging
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(BENCH, '..')
+sys.path.insert(0, ROOT)
+import helm2yaml
+import runner
+import synthetic
+
+def measure(fn, prepare, rounds):
+    '''Return best time of fn(prepare()) over rounds and the peak memory allocated by fn in MiB'''
+    best = None
+    for _ in range(rounds):
+        data = prepare()
+        t0 = time.perf_counter()
+        fn(data)
+        dt = time.perf_counter()-t0
+        best = dt if best is None else min(best, dt)
+    data = prepare()
+    tracemalloc.start()
+    fn(data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak/1024.0/1024
+
+def stages(text, args, rounds):
+    '''Measure the pipeline stages, each on the output of the previous stage'''
+    opts = argparse.Namespace(hook_filter=['test'], auto_api_upgrade=True, api_upgrade_rules=args.api_upgrade_rules,
+                              separate_with_namespace=True, separate_secrets=True, no_sort=False)
+    parsed = list(helm2yaml.yaml2dict(text))
+    classified = list(itertools.chain(*helm2yaml.resource_classify(copy.deepcopy(parsed), opts)))
+
+    # Stages mutating resources are given fresh copies, outside of the measured time
+    yield 'yaml2dict', len(parsed), measure(lambda t: list(helm2yaml.yaml2dict(t)), lambda: text, rounds)
+    yield 'resource_classify', len(parsed), measure(lambda d: helm2yaml.resource_classify(d, opts),
+                                                    lambda: copy.deepcopy(parsed), rounds)
+    yield 'list_images', len(classified), measure(helm2yaml.list_images, lambda: classified, rounds)
+    yield 'emit_resources', len(classified), measure(lambda d: helm2yaml.emit_resources(io.StringIO(), d),
+                                                     lambda: classified, rounds)
+    yield 'emit_resource_list', len(classified), measure(lambda d: helm2yaml.emit_resource_list(io.StringIO(), d),
+                                                         lambda: classified, rounds)
+    # Schemas are compiled in each round
+    schemas = tempfile.mkdtemp()
+    try:
+        synthetic.write_schemas(schemas)
+        yield 'validate', len(classified), measure(lambda d: helm2yaml.SchemaValidator(helm2yaml.SchemaIndex(schemas)).validate('bench', d),
+                                                   lambda: classified, rounds)
+    finally:
+        shutil.rmtree(schemas, ignore_errors=True)
+
+def end_to_end(template, count, rounds):
+    '''Measure helm2yaml.py with bench/fakehelm.py printing template'''
+    tmpdir = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(tmpdir, 'spec.yaml'), 'w') as fh:
+            fh.write('helmCharts:\n'
+                     '- name: bench\n  repo: https://charts.example.com\n  version: 1.0.0\n'
+                     '  releaseName: bench\n  namespace: bench\n')
+        env = dict(os.environ, FAKEHELM_TEMPLATE=template)
+        base = [sys.executable, os.path.join(ROOT, 'helm2yaml.py'), '-l', 'ERROR', '-b', os.path.join(BENCH, 'fakehelm.py'),
+                '--hook-filter', 'test', '--auto-api-upgrade']
+        krm = ['krm', '-f', os.path.join(tmpdir, 'spec.yaml')]
+        runs = [('e2e file', ['--render-path', tmpdir, '--separate-secrets', '--separate-with-namespace']),
+                ('e2e stdout', ['-o', 'stdout']),
+                ('e2e list-images', ['--list-images'])]
+        for name, opts in runs:
+            dt, peak, _ = runner.run_process(base + opts + krm, env, rounds)
+            yield name, count, (dt, peak)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description='Resource pipeline benchmark')
+    parser.add_argument('-n', dest='count', default=5000, type=int, help='Number of resources')
+    parser.add_argument('--crds', default=10, type=int, help='Number of CustomResourceDefinitions')
+    parser.add_argument('--crd-properties', default=500, type=int, help='Schema properties per CustomResourceDefinition')
+    parser.add_argument('--api-upgrade-rules', default=None, action='append',
+                        help="API upgrade rule files, default examples/api-upgrade-rules.yaml. '' for none")
+    parser.add_argument('-r', dest='rounds', default=3, type=int, help='Rounds, best time is reported')
+    parser.add_argument('--json', default=None, help='Write results to file')
+    parser.add_argument('--baseline', default=None, help='Compare with results from a previous run written with --json')
+    args = parser.parse_args()
+    if args.api_upgrade_rules is None:
+        args.api_upgrade_rules = [os.path.join(ROOT, 'examples', 'api-upgrade-rules.yaml')]
+    args.api_upgrade_rules = [fn for fn in args.api_upgrade_rules if fn]
+    logging.basicConfig(level=logging.ERROR)
+
+    text = synthetic.chart_template('bench', 'bench', args.count, args.crds, args.crd_properties)
+    tmpl = tempfile.NamedTemporaryFile('w', suffix='.yaml', delete=False)
+    with tmpl:
+        tmpl.write(text)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)['results']
+
+    print('Template output: {} resources, {} CRDs, {:.1f} MiB'.format(args.count, args.crds, len(text)/1024.0/1024))
+    print('{:22s} {:>9s} {:>10s} {:>12s} {:>10s} {:>10s}'.format('Stage', 'Resources', 'Time [s]', 'Res/s', 'Peak [MiB]',
+                                                                 'vs base'))
+    results = {}
+    try:
+        for name, n, (t, peak) in itertools.chain(stages(text, args, args.rounds),
+                                                    end_to_end(tmpl.name, args.count+args.crds, args.rounds)):
+            results[name] = {'resources': n, 'time': t, 'peak_mib': peak}
+            delta = ''
+            if name in baseline:
+                delta = '{:+.0f}%'.format((t/baseline[name]['time']-1)*100)
+            print('{:22s} {:9d} {:10.3f} {:12.0f} {:10.2f} {:>10s}'.format(name, n, t, n/t, peak, delta))
+    finally:
+        os.remove(tmpl.name)
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump({'args': vars(args), 'results': results}, fh, indent=2)
+
+if __name__ == "__main__":
+   sys.exit(main())
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+'''Benchmark --raw-passthrough against full parse and re-dump, on output the size of kube-prometheus-stack
+
+kube-prometheus-stack renders about 150 resources and 10 large
+CustomResourceDefinitions, about 5 MiB of YAML. Runs offline with
+bench/fakehelm.py as helm binary. Exits non-zero if the resources written with
+--raw-passthrough differ from those written without it.
+'''
+
+import sys, os
+import argparse
+import shutil
+import tempfile
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(BENCH, '..')
+sys.path.insert(0, ROOT)
+import helm2yaml
+import runner
+import synthetic
+
+def rendered(path, stdout):
+    '''Resources of all files in path, or of the ResourceList in stdout, by identity'''
+    res = []
+    if stdout:
+        res = list(helm2yaml.yaml2dict(stdout, expand_env=False))[0]['items']
+    else:
+        for fn in sorted(os.listdir(path)):
+            if fn.endswith('.yaml'):
+                with open(os.path.join(path, fn)) as fh:
+                    res.extend(helm2yaml.yaml2dict(fh, expand_env=False))
+    return {helm2yaml.resource_key(r): r for r in res}
+
+def main():
+    parser = argparse.ArgumentParser(description='Raw pass-through benchmark')
+    parser.add_argument('-n', dest='count', default=150, type=int, help='Number of resources')
+    parser.add_argument('--crds', default=10, type=int, help='Number of CustomResourceDefinitions')
+    parser.add_argument('--crd-properties', default=1000, type=int, help='Schema properties per CustomResourceDefinition')
+    parser.add_argument('-r', dest='rounds', default=3, type=int, help='Rounds, best time is reported')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    failures = []
+    try:
+        text = synthetic.chart_template('kps', 'monitoring', args.count, args.crds, args.crd_properties)
+        tmpl = os.path.join(tmpdir, 'template.yaml')
+        with open(tmpl, 'w') as fh:
+            fh.write(text)
+        spec = os.path.join(tmpdir, 'spec.yaml')
+        with open(spec, 'w') as fh:
+            fh.write('helmCharts:\n'
+                     '- name: kube-prometheus-stack\n  repo: https://charts.example.com\n  version: 1.0.0\n'
+                     '  releaseName: kps\n  namespace: monitoring\n')
+        env = dict(os.environ, FAKEHELM_TEMPLATE=tmpl)
+        base = [sys.executable, os.path.join(ROOT, 'helm2yaml.py'), '-l', 'ERROR', '-b', os.path.join(BENCH, 'fakehelm.py'),
+                '--hook-filter', 'test', '--auto-api-upgrade', '--no-repo-index']
+        print('Template output: {} resources, {} CRDs, {:.1f} MiB'.format(args.count, args.crds, len(text)/1024.0/1024))
+        print('{:10s} {:8s} {:>10s} {:>10s} {:>10s}'.format('Output', 'Mode', 'Time [s]', 'Speedup', 'Peak [MiB]'))
+        for output, opts in [('file', ['--separate-secrets', '--separate-with-namespace']), ('stdout', ['-o', 'stdout'])]:
+            results = {}
+            for mode, raw in [('parse', []), ('raw', ['--raw-passthrough'])]:
+                outdir = os.path.join(tmpdir, output+'-'+mode)
+                cmd = base + ['--render-path', outdir] + opts + raw + ['krm', '-f', spec]
+                dt, peak, out = runner.run_process(cmd, env, args.rounds, capture=True)
+                results[mode] = (dt, rendered(outdir, out if output == 'stdout' else None))
+                speedup = '{:.1f}x'.format(results['parse'][0]/dt)
+                print('{:10s} {:8s} {:10.3f} {:>10s} {:10.1f}'.format(output, mode, dt, speedup, peak))
+            if results['parse'][1] != results['raw'][1]:
+                failures.append('{}: resources differ with --raw-passthrough'.format(output))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    for f in failures:
+        print('FAILED: {}'.format(f))
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+   sys.exit(main())
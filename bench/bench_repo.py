@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+'''Benchmark and check chart resolution against bench/fakerepo.py, helm pull per release versus the repository index
+
+Runs offline with bench/fakehelm.py as helm binary, which pulls like helm by
+downloading and parsing the repository index for every chart. Exits non-zero
+if the repository index is not fetched once per run, charts are not
+downloaded once each or output differs from that of helm pull.
+'''
+
+import sys, os
+import argparse
+import filecmp
+import shutil
+import subprocess
+import tempfile
+import time
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(BENCH, '..')
+import fakerepo
+
+def write_spec(fname, repo, releases, charts, version):
+    with open(fname, 'w') as fh:
+        fh.write('helmCharts:\n')
+        for n in range(releases):
+            fh.write('- name: chart{}\n  repo: {}\n  version: {}\n  releaseName: rel{}\n  namespace: ns{}\n'.format(
+                n % charts, repo, version, n, n))
+
+def run(repo, spec, outdir, opts, jobs):
+    '''Run helm2yaml.py, returning wall time and repository requests'''
+    env = dict(os.environ, FAKEHELM_PULL_HTTP='1', FAKEHELM_RESOURCES='10')
+    cmd = [sys.executable, os.path.join(ROOT, 'helm2yaml.py'), '-l', 'ERROR', '-b', os.path.join(BENCH, 'fakehelm.py'),
+           '-j', str(jobs), '--render-path', outdir] + opts + ['krm', '-f', spec]
+    before = dict(repo.stats)
+    t0 = time.perf_counter()
+    subprocess.run(cmd, env=env, check=True)
+    dt = time.perf_counter()-t0
+    return dt, {k: v-before[k] for k, v in repo.stats.items()}
+
+def same_output(a, b):
+    cmp = filecmp.dircmp(a, b, ignore=['.helm2yaml.manifest'])
+    return not (cmp.left_only or cmp.right_only or filecmp.cmpfiles(a, b, cmp.common_files, shallow=False)[1])
+
+def main():
+    parser = argparse.ArgumentParser(description='Chart repository benchmark')
+    parser.add_argument('-n', dest='releases', default=20, type=int, help='Number of releases')
+    parser.add_argument('--charts', default=5, type=int, help='Number of distinct charts used by releases')
+    parser.add_argument('--index-charts', default=500, type=int, help='Number of charts in repository index')
+    parser.add_argument('--index-versions', default=10, type=int, help='Number of versions per chart in repository index')
+    parser.add_argument('-j', dest='jobs', default=4, type=int, help='Concurrent releases')
+    args = parser.parse_args()
+
+    repo = fakerepo.FakeRepo(max(args.index_charts, args.charts), max(args.index_versions, 2))
+    tmpdir = tempfile.mkdtemp()
+    failures = []
+    try:
+        spec = os.path.join(tmpdir, 'spec.yaml')
+        spec2 = os.path.join(tmpdir, 'spec2.yaml')
+        write_spec(spec, repo.url, args.releases, args.charts, '1.0.0')
+        write_spec(spec2, repo.url, args.releases, args.charts, '1.0.1')
+        cache = os.path.join(tmpdir, 'cache')
+        print('Repository index: {:.1f} MiB, {} releases using {} charts'.format(len(repo.index)/1024.0/1024,
+                                                                                 args.releases, args.charts))
+        print('{:22s} {:>10s} {:>8s} {:>9s} {:>12s}'.format('Mode', 'Time [s]', 'Index', 'Archives', 'Connections'))
+        runs = [('helm pull', spec, 'helm', ['--no-repo-index']),
+                ('repo index', spec, 'index', []),
+                ('index, cache dir', spec, 'cached', ['--cache-dir', cache]),
+                ('cached index', spec2, 'cached2', ['--cache-dir', cache])]
+        for name, s, out, opts in runs:
+            dt, stats = run(repo, s, os.path.join(tmpdir, out), opts, args.jobs)
+            print('{:22s} {:10.3f} {:8d} {:9d} {:12d}'.format(name, dt, stats['index'], stats['archives'], stats['connections']))
+            if out == 'helm':
+                continue
+            if stats['index'] != (0 if out == 'cached2' else 1):
+                failures.append('{}: index fetched {} times'.format(name, stats['index']))
+            if stats['archives'] != args.charts:
+                failures.append('{}: {} archives downloaded, expected {}'.format(name, stats['archives'], args.charts))
+            if out != 'cached2' and not same_output(os.path.join(tmpdir, 'helm'), os.path.join(tmpdir, out)):
+                failures.append('{}: output differs from helm pull'.format(name))
+    finally:
+        repo.close()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    for f in failures:
+        print('FAILED: {}'.format(f))
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+   sys.exit(main())
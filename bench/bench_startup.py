@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+'''Measure helm2yaml.py import time per command with 'python -X importtime' and check it against startup_budget.json'''
+
+import sys, os
+import argparse
+import json
+import shutil
+import subprocess
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+BUDGET = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'startup_budget.json')
+
+def importtime(cmd):
+    '''Run cmd with -X importtime, returning the top-level imports as a list of (module, cumulative us)'''
+    proc = subprocess.run([sys.executable, '-X', 'importtime'] + cmd, cwd=ROOT, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE, universal_newlines=True)
+    if proc.returncode not in (0, 255):    # '--help' exits with 0, no sub-command with -1
+        sys.exit("Command '{}' failed:\n{}".format(' '.join(cmd), proc.stderr))
+    imports = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not name.startswith('  '):    # Nested imports are included in the cumulative time
+            imports.append((name.strip(), int(cumulative)))
+    return imports
+
+def modules(cmd):
+    '''All modules imported by cmd'''
+    proc = subprocess.run([sys.executable, '-X', 'importtime'] + cmd, cwd=ROOT, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE, universal_newlines=True)
+    return set([line.split('|')[2].strip() for line in proc.stderr.splitlines()
+                if line.startswith('import time:') and 'cumulative' not in line])
+
+def main():
+    parser = argparse.ArgumentParser(description='Startup time benchmark')
+    parser.add_argument('-n', dest='rounds', default=7, type=int, help='Runs per command, the median is reported')
+    parser.add_argument('--budget', default=BUDGET, help='Budget file')
+    args = parser.parse_args()
+
+    with open(args.budget) as fh:
+        budget = json.load(fh)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        # Modules imported by the interpreter itself are not accounted to helm2yaml.py
+        interpreter = set([name for name, _ in importtime(['-c', 'pass'])])
+
+        failed = False
+        print('{:20s} {:>12s} {:>12s}  {}'.format('Command', 'Import [ms]', 'Budget [ms]', 'Slowest imports'))
+        for name, spec in budget['commands'].items():
+            cmd = [os.path.join(ROOT, 'helm2yaml.py')] + [a.format(tmpdir=tmpdir) for a in spec['args']]
+            samples = []
+            for _ in range(args.rounds):
+                imports = [(m, t) for m, t in importtime(cmd) if m not in interpreter]
+                samples.append((sum([t for _, t in imports]), imports))
+            samples.sort(key=lambda s: s[0])
+            total, imports = samples[len(samples)//2]
+            slowest = ', '.join(['{} {:.1f}'.format(m, t/1000.0) for m, t in sorted(imports, key=lambda i: -i[1])[:3]])
+            print('{:20s} {:12.1f} {:12.1f}  {}'.format(name, total/1000.0, spec['max_import_ms'], slowest))
+            if total/1000.0 > spec['max_import_ms']:
+                print('  FAIL: import time exceeds budget')
+                failed = True
+            loaded = modules(cmd) & set(spec.get('forbidden', []))
+            if loaded:
+                print('  FAIL: imports {}'.format(', '.join(sorted(loaded))))
+                failed = True
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+   sys.exit(main())
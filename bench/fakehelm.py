@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+'''Offline stand-in for the helm binary, use with 'helm2yaml.py -b bench/fakehelm.py'
+
+Supports 'pull' and 'template'. Pulled charts are minimal archives and
+template output is synthetic, configured with environment variables:
+
+  FAKEHELM_RESOURCES       Number of resources per release, default 100
+  FAKEHELM_CRDS            Number of CustomResourceDefinitions per release, default 0
+  FAKEHELM_CRD_PROPERTIES  Schema properties per CustomResourceDefinition, default 500
+  FAKEHELM_SLEEP           Seconds to sleep per command, emulating network and helm latency
+  FAKEHELM_TEMPLATE        File with template output to print instead of synthetic resources
+  FAKEHELM_SHOW_VALUES     If set, add a ConfigMap '<release>-values' with the merged values
+  FAKEHELM_PULL_HTTP       If set, 'pull --repo' downloads and parses the repository index and
+                           downloads the archive like helm does, e.g. from bench/fakerepo.py
+'''
+
+import sys, os
+import argparse
+import gzip
+import io
+import shutil
+import tarfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import synthetic
+
+def add_file(tf, name, data):
+    data = data.encode('UTF-8')
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = 0
+    tf.addfile(info, io.BytesIO(data))
+
+def pull_http(args):
+    '''Download chart archive using the repository index, a new connection per request like helm'''
+    import urllib.parse
+    import urllib.request
+    import yaml
+    with urllib.request.urlopen(args.repo.rstrip('/')+'/index.yaml') as resp:
+        index = yaml.load(resp.read(), Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+    for entry in index['entries'].get(args.chart, []):
+        if str(entry['version']) == args.version:
+            url = urllib.parse.urljoin(args.repo.rstrip('/')+'/', entry['urls'][0])
+            with urllib.request.urlopen(url) as resp:
+                with open(os.path.join(args.destination, '{}-{}.tgz'.format(args.chart, args.version)), 'wb') as fh:
+                    shutil.copyfileobj(resp, fh)
+            return 0
+    sys.exit("Error: chart '{}' version '{}' not found in {} index".format(args.chart, args.version, args.repo))
+
+def do_pull(args):
+    if args.repo and os.environ.get('FAKEHELM_PULL_HTTP'):
+        return pull_http(args)
+    chart = args.chart.rstrip('/').split('/')[-1]
+    version = args.version or '0.1.0'
+    # Same archive on every pull, like a chart repository serves
+    with gzip.GzipFile(os.path.join(args.destination, '{}-{}.tgz'.format(chart, version)), 'wb', mtime=0) as gz:
+        with tarfile.open(fileobj=gz, mode='w') as tf:
+            add_file(tf, '{}/Chart.yaml'.format(chart), 'apiVersion: v2\nname: {}\nversion: {}\n'.format(chart, version))
+            add_file(tf, '{}/values.yaml'.format(chart), 'replicas: 1\n')
+    return 0
+
+def merge(dst, src):
+    for k,v in src.items():
+        if isinstance(v, dict) and isinstance(dst.get(k), dict):
+            merge(dst[k], v)
+        else:
+            dst[k] = v
+
+def typed(v):
+    if v.lower() in ['true', 'false']:
+        return v.lower() == 'true'
+    if v.isdigit() and not v.startswith('0'):
+        return int(v)
+    return v
+
+def show_values(args):
+    '''Return a ConfigMap with values merged from values files and --set, a subset of what helm supports'''
+    import yaml
+    values = {}
+    for fname in args.values:
+        with open(fname, 'r') as fh:
+            merge(values, yaml.safe_load(fh) or {})
+    for kv in args.set:
+        key, v = kv.split('=', 1)
+        node = values
+        path = key.split('.')
+        for k in path[:-1]:
+            node = node.setdefault(k, {})
+        node[path[-1]] = typed(v)
+    return yaml.dump({'apiVersion': 'v1', 'kind': 'ConfigMap', 'metadata': {'name': args.release+'-values'},
+                      'data': {'values': yaml.dump(values, sort_keys=True)}})
+
+def do_template(args):
+    if not os.path.isdir(args.chart):
+        sys.exit("Error: chart '{}' not found".format(args.chart))
+    for fname in args.values:
+        if not os.path.exists(fname):
+            sys.exit("Error: values file '{}' not found".format(fname))
+    if os.environ.get('FAKEHELM_SHOW_VALUES'):
+        sys.stdout.write('---\n' + show_values(args))
+    template = os.environ.get('FAKEHELM_TEMPLATE')
+    if template:
+        with open(template, 'r') as fh:
+            shutil.copyfileobj(fh, sys.stdout)
+        return 0
+    sys.stdout.write(synthetic.chart_template(args.release, args.namespace or 'default',
+                                              int(os.environ.get('FAKEHELM_RESOURCES', '100')),
+                                              int(os.environ.get('FAKEHELM_CRDS', '0')),
+                                              int(os.environ.get('FAKEHELM_CRD_PROPERTIES', '500'))))
+    return 0
+
+def do_version(args):
+    print('v3.0.0+fake')
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake helm for offline benchmarks')
+    subparsers = parser.add_subparsers()
+    parser_version = subparsers.add_parser('version')
+    parser_version.set_defaults(func=do_version)
+    parser_version.add_argument('--short', action='store_true')
+    parser_pull = subparsers.add_parser('pull')
+    parser_pull.set_defaults(func=do_pull)
+    parser_pull.add_argument('chart')
+    parser_pull.add_argument('--repo')
+    parser_pull.add_argument('--version')
+    parser_pull.add_argument('--destination', default='.')
+    parser_template = subparsers.add_parser('template')
+    parser_template.set_defaults(func=do_template)
+    parser_template.add_argument('release')
+    parser_template.add_argument('chart')
+    parser_template.add_argument('--namespace')
+    parser_template.add_argument('--include-crds', action='store_true')
+    parser_template.add_argument('--kube-version')
+    parser_template.add_argument('--api-versions', action='append', default=[])
+    parser_template.add_argument('--set', action='append', default=[])
+    parser_template.add_argument('--values', action='append', default=[])
+
+    args = parser.parse_args()
+    if not hasattr(args, 'func'):
+        parser.print_help()
+        return 1
+    time.sleep(float(os.environ.get('FAKEHELM_SLEEP', '0')))
+    return args.func(args)
+
+if __name__ == "__main__":
+   sys.exit(main())
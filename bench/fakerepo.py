@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+'''Local stand-in for a classic Helm chart repository, serving index.yaml and chart archives over HTTP/1.1
+
+The index lists '--charts' charts named chart0, chart1, ... with '--versions'
+versions 1.0.0, 1.0.1, ... each. Archives are minimal charts, generated
+deterministically such that digests in the index match. Requests and
+connections are counted, see 'FakeRepo.stats'.
+'''
+
+import sys
+import argparse
+import gzip
+import hashlib
+import http.server
+import io
+import tarfile
+import threading
+
+def chart_archive(chart, version):
+    '''Return a minimal chart archive, identical for each call'''
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as gz:
+        with tarfile.open(fileobj=gz, mode='w') as tf:
+            for name, data in [('Chart.yaml', 'apiVersion: v2\nname: {}\nversion: {}\n'.format(chart, version)),
+                               ('values.yaml', 'replicas: 1\n')]:
+                data = data.encode('UTF-8')
+                info = tarfile.TarInfo('{}/{}'.format(chart, name))
+                info.size = len(data)
+                tf.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+def repo_index(charts, versions):
+    '''Return index.yaml text and the archives by path'''
+    archives = {}
+    out = ['apiVersion: v1\nentries:\n']
+    for c in range(charts):
+        chart = 'chart{}'.format(c)
+        out.append('  {}:\n'.format(chart))
+        for v in range(versions):
+            version = '1.0.{}'.format(v)
+            path = 'charts/{}-{}.tgz'.format(chart, version)
+            archives['/'+path] = data = chart_archive(chart, version)
+            out.append('  - apiVersion: v2\n'
+                       '    appVersion: {version}\n'
+                       '    created: "2021-01-01T00:00:00.000000000Z"\n'
+                       '    description: A synthetic chart for benchmarking chart resolution, part of a large index\n'
+                       '    digest: {digest}\n'
+                       '    home: https://charts.example.com/{chart}\n'
+                       '    maintainers:\n'
+                       '    - email: maintainer@example.com\n'
+                       '      name: maintainer\n'
+                       '    name: {chart}\n'
+                       '    sources:\n'
+                       '    - https://github.com/example/{chart}\n'
+                       '    urls:\n'
+                       '    - {path}\n'
+                       '    version: {version}\n'.format(chart=chart, version=version, path=path,
+                                                        digest=hashlib.sha256(data).hexdigest()))
+    out.append('generated: "2021-01-01T00:00:00.000000000Z"\n')
+    return ''.join(out).encode('UTF-8'), archives
+
+class FakeRepo:
+    '''Repository served from a background thread on 127.0.0.1'''
+    def __init__(self, charts=100, versions=10, port=0):
+        self.index, self.archives = repo_index(charts, versions)
+        self.stats = {'connections': 0, 'index': 0, 'archives': 0, 'not_found': 0}
+        self._lock = threading.Lock()
+        repo = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                repo.count('connections')
+
+            def do_GET(self):
+                path = self.path.split('?')[0]
+                if path == '/index.yaml':
+                    repo.count('index')
+                    data = repo.index
+                elif path in repo.archives:
+                    repo.count('archives')
+                    data = repo.archives[path]
+                else:
+                    repo.count('not_found')
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, fmt, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake Helm chart repository')
+    parser.add_argument('-p', dest='port', default=8879, type=int, help='Port, zero to pick a free port')
+    parser.add_argument('--charts', default=100, type=int, help='Number of charts in index')
+    parser.add_argument('--versions', default=10, type=int, help='Number of versions per chart')
+    args = parser.parse_args()
+    repo = FakeRepo(args.charts, args.versions, args.port)
+    print('Serving {} charts, index {:.1f} MiB, at {}'.format(args.charts, len(repo.index)/1024.0/1024, repo.url))
+    try:
+        repo.thread.join()
+    except KeyboardInterrupt:
+        repo.close()
+    return 0
+
+if __name__ == "__main__":
+   sys.exit(main())
@@ -0,0 +1,29 @@
+'''Time and peak memory of helm2yaml.py processes, shared by the benchmarks'''
+
+import sys, os
+import subprocess
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# A wrapper process such that peak RSS is that of the command and its children only. The peak is
+# written as the last line of stderr
+WRAPPER = ('import resource, subprocess, sys\n'
+           'rc = subprocess.run(sys.argv[1:]).returncode\n'
+           'sys.stderr.write("\\n{}\\n".format(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss))\n'
+           'sys.exit(rc)\n')
+
+def run_process(cmd, env, rounds=1, capture=False):
+    '''Return best wall time of running cmd over rounds, the peak RSS of the last round in MiB and its
+    output if capture is set'''
+    best = None
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        proc = subprocess.run([sys.executable, '-c', WRAPPER] + cmd, env=env, cwd=ROOT,
+                              stdout=subprocess.PIPE if capture else subprocess.DEVNULL, stderr=subprocess.PIPE)
+        dt = time.perf_counter()-t0
+        if proc.returncode:
+            sys.exit("Command '{}' failed:\n{}".format(' '.join(cmd), proc.stderr.decode('UTF-8')))
+        best = dt if best is None else min(best, dt)
+    peak = int(proc.stderr.split()[-1])/1024.0
+    return best, peak, proc.stdout.decode('UTF-8') if capture else None
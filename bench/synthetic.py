@@ -0,0 +1,216 @@
+'''Synthetic Kubernetes resources for benchmarking helm2yaml'''
+
+def deployment(name, namespace=None, api='apps/v1', image='registry.example.com/app:1.0.0'):
+    meta = {'name': name, 'labels': {'app.kubernetes.io/name': name, 'app.kubernetes.io/instance': 'bench'}}
+    if namespace:
+        meta['namespace'] = namespace
+    return {'apiVersion': api, 'kind': 'Deployment', 'metadata': meta,
+            'spec': {'replicas': 1,
+                     'selector': {'matchLabels': {'app.kubernetes.io/name': name}},
+                     'template': {'metadata': {'labels': {'app.kubernetes.io/name': name}},
+                                  'spec': {'containers': [{'name': 'main', 'image': image,
+                                                           'args': ['--listen=:8080', '--log-level=info'],
+                                                           'ports': [{'containerPort': 8080, 'name': 'http'}],
+                                                           'resources': {'limits': {'cpu': '100m', 'memory': '128Mi'}}}]}}}}
+
+def configmap(name, namespace=None, size=8):
+    meta = {'name': name}
+    if namespace:
+        meta['namespace'] = namespace
+    return {'apiVersion': 'v1', 'kind': 'ConfigMap', 'metadata': meta,
+            'data': {'key{}'.format(i): 'value-{}-'.format(i)*4 for i in range(size)}}
+
+def resources(count, namespace=None):
+    '''Return a list of count mixed resources'''
+    out = []
+    for i in range(count):
+        if i % 2:
+            out.append(deployment('app-{}'.format(i), namespace))
+        else:
+            out.append(configmap('config-{}'.format(i), namespace))
+    return out
+
+def secret(name, namespace=None):
+    meta = {'name': name}
+    if namespace:
+        meta['namespace'] = namespace
+    return {'apiVersion': 'v1', 'kind': 'Secret', 'metadata': meta, 'type': 'Opaque',
+            'data': {'username': 'YWRtaW4=', 'password': 'c2VjcmV0LXBhc3N3b3Jk'}}
+
+def service(name, namespace=None):
+    meta = {'name': name, 'labels': {'app.kubernetes.io/name': name}}
+    if namespace:
+        meta['namespace'] = namespace
+    return {'apiVersion': 'v1', 'kind': 'Service', 'metadata': meta,
+            'spec': {'type': 'ClusterIP', 'selector': {'app.kubernetes.io/name': name},
+                     'ports': [{'name': 'http', 'port': 80, 'targetPort': 'http', 'protocol': 'TCP'}]}}
+
+def statefulset(name, namespace=None, api='apps/v1'):
+    res = deployment(name, namespace, api)
+    res['kind'] = 'StatefulSet'
+    res['spec']['serviceName'] = name
+    res['spec']['template']['spec']['initContainers'] = [{'name': 'init', 'image': 'registry.example.com/init:1.0.0',
+                                                          'command': ['sh', '-c', 'true']}]
+    return res
+
+def hook_pod(name, namespace=None, hook='test'):
+    '''A Helm test hook Pod'''
+    meta = {'name': name, 'annotations': {'helm.sh/hook': hook, 'helm.sh/hook-delete-policy': 'hook-succeeded'}}
+    if namespace:
+        meta['namespace'] = namespace
+    return {'apiVersion': 'v1', 'kind': 'Pod', 'metadata': meta,
+            'spec': {'restartPolicy': 'Never',
+                     'containers': [{'name': 'test', 'image': 'registry.example.com/curl:7.0.0',
+                                     'command': ['curl', 'http://{}'.format(name)]}]}}
+
+def hook_job(name, namespace=None, hook='pre-install'):
+    meta = {'name': name, 'annotations': {'helm.sh/hook': hook, 'helm.sh/hook-weight': '-5'}}
+    if namespace:
+        meta['namespace'] = namespace
+    return {'apiVersion': 'batch/v1', 'kind': 'Job', 'metadata': meta,
+            'spec': {'template': {'spec': {'restartPolicy': 'OnFailure',
+                                           'containers': [{'name': 'migrate', 'image': 'registry.example.com/migrate:1.0.0'}]}}}}
+
+def cronjob(name, namespace=None, api='batch/v1beta1'):
+    meta = {'name': name}
+    if namespace:
+        meta['namespace'] = namespace
+    return {'apiVersion': api, 'kind': 'CronJob', 'metadata': meta,
+            'spec': {'schedule': '*/5 * * * *',
+                     'jobTemplate': {'spec': {'template': {'spec': {'restartPolicy': 'OnFailure',
+                                                                    'containers': [{'name': 'cron', 'image': 'registry.example.com/cron:1.0.0'}]}}}}}}
+
+def cluster_role(name, api='rbac.authorization.k8s.io/v1beta1'):
+    return {'apiVersion': api, 'kind': 'ClusterRole', 'metadata': {'name': name},
+            'rules': [{'apiGroups': [''], 'resources': ['pods', 'services', 'endpoints'], 'verbs': ['get', 'list', 'watch']}]}
+
+def network_policy(name, namespace=None, api='extensions/v1beta1'):
+    meta = {'name': name}
+    if namespace:
+        meta['namespace'] = namespace
+    return {'apiVersion': api, 'kind': 'NetworkPolicy', 'metadata': meta,
+            'spec': {'podSelector': {'matchLabels': {'app.kubernetes.io/name': name}}, 'policyTypes': ['Ingress']}}
+
+def pod_disruption_budget(name, namespace=None, api='policy/v1beta1'):
+    meta = {'name': name}
+    if namespace:
+        meta['namespace'] = namespace
+    return {'apiVersion': api, 'kind': 'PodDisruptionBudget', 'metadata': meta,
+            'spec': {'minAvailable': 1, 'selector': {'matchLabels': {'app.kubernetes.io/name': name}}}}
+
+def crd(name, properties=500):
+    '''A CustomResourceDefinition with a large schema, like those of operator charts'''
+    props = {}
+    for i in range(properties):
+        props['field{}'.format(i)] = {'type': 'object', 'description': 'Field {} of the custom resource. '.format(i)*3,
+                                      'properties': {'enabled': {'type': 'boolean'},
+                                                     'value': {'type': 'string', 'pattern': '^[a-z0-9=-]+$'},
+                                                     'count': {'type': 'integer', 'format': 'int32', 'minimum': 0}}}
+    group = 'bench.example.com'
+    return {'apiVersion': 'apiextensions.k8s.io/v1', 'kind': 'CustomResourceDefinition',
+            'metadata': {'name': '{}s.{}'.format(name, group)},
+            'spec': {'group': group, 'scope': 'Namespaced',
+                     'names': {'kind': name.capitalize(), 'plural': name+'s', 'singular': name, 'listKind': name.capitalize()+'List'},
+                     'versions': [{'name': 'v1', 'served': True, 'storage': True,
+                                   'schema': {'openAPIV3Schema': {'type': 'object',
+                                                                  'properties': {'spec': {'type': 'object', 'properties': props}}}}}]}}
+
+# Resources of a release cycle through this mix. Every other cycle has an explicit namespace
+MIX = [
+    lambda n, ns: deployment(n, ns),
+    lambda n, ns: configmap(n, ns),
+    lambda n, ns: service(n, ns),
+    lambda n, ns: secret(n, ns),
+    lambda n, ns: statefulset(n, ns),
+    lambda n, ns: hook_pod(n, ns),
+    lambda n, ns: hook_job(n, ns),
+    lambda n, ns: deployment(n, ns, api='extensions/v1beta1'),
+    lambda n, ns: statefulset(n, ns, api='apps/v1beta2'),
+    lambda n, ns: cronjob(n, ns),
+    lambda n, ns: cluster_role(n),
+    lambda n, ns: network_policy(n, ns),
+    lambda n, ns: pod_disruption_budget(n, ns),
+]
+
+def chart_resources(release, namespace, count, crds=0, crd_properties=500):
+    '''Return CRDs followed by count resources of the mix, as rendered for a release'''
+    out = [crd('{}crd{}'.format(release.replace('-', ''), i), crd_properties) for i in range(crds)]
+    for i in range(count):
+        out.append(MIX[i % len(MIX)]('{}-{}'.format(release, i), namespace if (i // len(MIX)) % 2 else None))
+    return out
+
+def chart_template(release, namespace, count, crds=0, crd_properties=500):
+    '''Return the resources of chart_resources as 'helm template' output text'''
+    import yaml
+    dumper = getattr(yaml, 'CDumper', yaml.Dumper)
+    out = []
+    for r in chart_resources(release, namespace, count, crds, crd_properties):
+        out.append('---\n# Source: bench/templates/{}.yaml\n'.format(r['kind'].lower()))
+        out.append(yaml.dump(r, Dumper=dumper))
+    return ''.join(out)
+
+def write_schemas(path):
+    '''Write JSON schemas of the kinds of the mix, after API upgrades, laid out like kubernetes-json-schema'''
+    import json
+    import os
+    ref = lambda name: {'$ref': '_definitions.json#/definitions/{}'.format(name)}
+    strings = {'type': 'object', 'additionalProperties': {'type': 'string'}}
+    selector = {'type': 'object', 'properties': {'matchLabels': strings}}
+    definitions = {
+        'ObjectMeta': {'type': 'object', 'additionalProperties': False,
+                       'properties': {'name': {'type': 'string'}, 'namespace': {'type': 'string'},
+                                      'labels': strings, 'annotations': strings}},
+        'Container': {'type': 'object', 'required': ['name'], 'additionalProperties': False,
+                      'properties': {'name': {'type': 'string'}, 'image': {'type': 'string'},
+                                     'args': {'type': 'array', 'items': {'type': 'string'}},
+                                     'command': {'type': 'array', 'items': {'type': 'string'}},
+                                     'ports': {'type': 'array', 'items': {'type': 'object', 'properties': {
+                                         'containerPort': {'type': 'integer', 'minimum': 1, 'maximum': 65535},
+                                         'name': {'type': 'string', 'maxLength': 15}}}},
+                                     'resources': {'type': 'object', 'properties': {
+                                         'limits': {'type': 'object', 'additionalProperties': {'x-kubernetes-int-or-string': True}}}}}},
+        'PodSpec': {'type': 'object', 'required': ['containers'],
+                    'properties': {'containers': {'type': 'array', 'items': ref('Container')},
+                                   'initContainers': {'type': 'array', 'items': ref('Container')},
+                                   'restartPolicy': {'type': 'string', 'enum': ['Always', 'OnFailure', 'Never']}}},
+        'PodTemplateSpec': {'type': 'object', 'properties': {'metadata': ref('ObjectMeta'), 'spec': ref('PodSpec')}},
+    }
+    workload = {'type': 'object', 'required': ['selector', 'template'],
+                'properties': {'replicas': {'type': 'integer', 'minimum': 0}, 'serviceName': {'type': 'string'},
+                               'selector': selector, 'template': ref('PodTemplateSpec')}}
+    specs = {
+        ('v1', 'ConfigMap'): {'data': strings},
+        ('v1', 'Secret'): {'data': strings, 'type': {'type': 'string'}},
+        ('v1', 'Service'): {'spec': {'type': 'object', 'properties': {
+            'type': {'type': 'string', 'enum': ['ClusterIP', 'NodePort', 'LoadBalancer', 'ExternalName']},
+            'selector': strings, 'ports': {'type': 'array', 'items': {'type': 'object', 'required': ['port'], 'properties': {
+                'port': {'type': 'integer'}, 'targetPort': {'x-kubernetes-int-or-string': True}}}}}}},
+        ('v1', 'Pod'): {'spec': ref('PodSpec')},
+        ('apps/v1', 'Deployment'): {'spec': workload},
+        ('apps/v1', 'StatefulSet'): {'spec': workload},
+        ('batch/v1', 'Job'): {'spec': {'type': 'object', 'properties': {'template': ref('PodTemplateSpec')}}},
+        ('batch/v1', 'CronJob'): {'spec': {'type': 'object', 'required': ['schedule'], 'properties': {
+            'schedule': {'type': 'string'},
+            'jobTemplate': {'type': 'object', 'properties': {'spec': {'type': 'object', 'properties': {
+                'template': ref('PodTemplateSpec')}}}}}}},
+        ('rbac.authorization.k8s.io/v1', 'ClusterRole'): {'rules': {'type': 'array', 'items': {'type': 'object', 'properties': {
+            'apiGroups': {'type': 'array', 'items': {'type': 'string'}}, 'resources': {'type': 'array', 'items': {'type': 'string'}},
+            'verbs': {'type': 'array', 'items': {'type': 'string'}}}}}},
+        ('networking.k8s.io/v1', 'NetworkPolicy'): {'spec': {'type': 'object', 'properties': {'podSelector': selector}}},
+        ('policy/v1', 'PodDisruptionBudget'): {'spec': {'type': 'object', 'properties': {
+            'minAvailable': {'x-kubernetes-int-or-string': True}, 'selector': selector}}},
+        ('apiextensions.k8s.io/v1', 'CustomResourceDefinition'): {'spec': {'type': 'object', 'x-kubernetes-preserve-unknown-fields': True}},
+    }
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, '_definitions.json'), 'w') as fh:
+        json.dump({'definitions': definitions}, fh)
+    for (api, kind), props in specs.items():
+        group, _, version = api.rpartition('/')
+        fname = '-'.join([kind.lower()] + ([group.split('.')[0]] if group else []) + [version]) + '.json'
+        schema = {'type': 'object', 'required': ['apiVersion', 'kind', 'metadata'], 'additionalProperties': False,
+                  'description': 'Synthetic schema of {} {}'.format(api, kind),
+                  'x-kubernetes-group-version-kind': [{'group': group, 'kind': kind, 'version': version}],
+                  'properties': dict(props, apiVersion={'type': 'string', 'enum': [api]}, kind={'type': 'string', 'enum': [kind]},
+                                     metadata=ref('ObjectMeta'))}
+        with open(os.path.join(path, fname), 'w') as fh:
+            json.dump(schema, fh)
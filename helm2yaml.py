@@ -3,20 +3,35 @@
 import sys, os
 import string, io
 import argparse
-import subprocess
-import yaml
 import logging
-import pprint
-import tempfile
 import contextlib
+import functools
+import time
+import threading
+import itertools
+import collections
+import heapq
+
+# Modules only needed by some commands, e.g. PyYAML, subprocess and
+# tempfile, are imported where used to keep startup time low. See
+# bench/bench_startup.py
 
 class ParseError(Exception):
     pass
 
+class FetchError(Exception):
+    pass
+
+def debug_enabled():
+    return logging.getLogger().isEnabledFor(logging.DEBUG)
+
+# Output is written in large blocks, rendered files are often several MiB
+OUTPUT_BUFFER_SIZE = 1024*1024
+
 @contextlib.contextmanager
 def fopener(filename=None):
     if filename and filename != '-':
-        fh = open(filename, 'w')
+        fh = open(filename, 'w', buffering=OUTPUT_BUFFER_SIZE)
     else:
         fh = sys.stdout
 
@@ -39,7 +54,128 @@ def fopener_read(filename=None):
         if fh is not sys.stdin:
             fh.close()
 
+class Metrics:
+    '''Wall and CPU time per phase and release plus counters, reported with --timings and --metrics-file'''
+    def __init__(self):
+        self.phases = {}    # (phase, release) -> [count, wall, cpu]
+        self.counters = {}  # (name, labels) -> value
+        self._lock = threading.Lock()
+
+    def add(self, phase, release, wall, cpu):
+        with self._lock:
+            acc = self.phases.setdefault((phase, release), [0, 0.0, 0.0])
+            acc[0] += 1
+            acc[1] += wall
+            acc[2] += cpu
+
+    @contextlib.contextmanager
+    def phase(self, phase, release=None):
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            self.add(phase, release, time.perf_counter()-wall, time.thread_time()-cpu)
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def phase_totals(self):
+        totals = {}
+        for (phase, release), (n, wall, cpu) in self.phases.items():
+            acc = totals.setdefault(phase, [0, 0.0, 0.0])
+            acc[0] += n
+            acc[1] += wall
+            acc[2] += cpu
+        return totals
+
+    def log_timings(self):
+        logging.info('{:<12s} {:>6s} {:>10s} {:>10s}'.format('Phase', 'Count', 'Wall [s]', 'CPU [s]'))
+        for phase, (n, wall, cpu) in sorted(self.phase_totals().items(), key=lambda x: -x[1][1]):
+            logging.info('{:<12s} {:>6d} {:>10.3f} {:>10.3f}'.format(phase, n, wall, cpu))
+        for (name, labels), value in sorted(self.counters.items()):
+            logging.info('{}{}: {}'.format(name, ''.join(['[{}={}]'.format(k, v) for k, v in labels]), value))
+
+    def to_json(self):
+        return {'phases': [{'phase': phase, 'release': release, 'count': n, 'wall_seconds': wall, 'cpu_seconds': cpu}
+                           for (phase, release), (n, wall, cpu) in sorted(self.phases.items(), key=lambda x: (x[0][0], x[0][1] or ''))],
+                'counters': [dict(labels, name=name, value=value)
+                             for (name, labels), value in sorted(self.counters.items())]}
+
+    def to_openmetrics(self):
+        def labelstr(labels):
+            esc = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            return ','.join(['{}="{}"'.format(k, esc(v)) for k, v in labels if v is not None])
+        out = []
+        for metric, idx, help in [('phase_wall_seconds', 1, 'Wall time spent per phase'),
+                                  ('phase_cpu_seconds', 2, 'CPU time spent per phase')]:
+            out.append('# TYPE helm2yaml_{} counter'.format(metric))
+            out.append('# HELP helm2yaml_{} {}'.format(metric, help))
+            for (phase, release), acc in sorted(self.phases.items(), key=lambda x: (x[0][0], x[0][1] or '')):
+                out.append('helm2yaml_{}_total{{{}}} {}'.format(metric, labelstr([('phase', phase), ('release', release)]), acc[idx]))
+        names = sorted(set([name for name, labels in self.counters.keys()]))
+        for name in names:
+            out.append('# TYPE helm2yaml_{} counter'.format(name))
+            for (n, labels), value in sorted(self.counters.items()):
+                if n == name:
+                    out.append('helm2yaml_{}_total{{{}}} {}'.format(name, labelstr(labels), value))
+        out.append('# EOF')
+        return '\n'.join(out)+'\n'
+
+    def write(self, fname, fmt):
+        import json
+        with fopener(fname) as fh:
+            if fmt == 'openmetrics':
+                fh.write(self.to_openmetrics())
+            else:
+                json.dump(self.to_json(), fh, indent=2)
+                fh.write('\n')
+
+METRICS = Metrics()
+
+class MeteredReader:
+    '''File-like wrapper accounting bytes read and time spent waiting for data'''
+    def __init__(self, fh):
+        self.fh = fh
+        self.nbytes = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+
+    def _metered(self, fn, *args):
+        wall, cpu = time.perf_counter(), time.thread_time()
+        data = fn(*args)
+        self.wall += time.perf_counter()-wall
+        self.cpu += time.thread_time()-cpu
+        self.nbytes += len(data.encode('UTF-8'))
+        return data
+
+    def read(self, size=-1):
+        return self._metered(self.fh.read, size)
+
+    def readline(self):
+        return self._metered(self.fh.readline)
+
+def metered(res, acc):
+    '''Iterate over res, accumulating wall and CPU time spent producing items into acc'''
+    it = iter(res)
+    while True:
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            r = next(it)
+        except StopIteration:
+            return
+        finally:
+            acc[0] += time.perf_counter()-wall
+            acc[1] += time.thread_time()-cpu
+        yield r
+
+def spec_source(fname):
+    '''Identity of a spec file, recorded in the manifest with the releases it defines'''
+    return fname if fname == '-' else os.path.realpath(fname)
+
 def parse_helmsman(fname):
+    import yaml
     specs = []
     repo = {}
     dirname = os.path.dirname(fname)
@@ -62,7 +198,8 @@ def parse_helmsman(fname):
                            'namespace':  app['namespace'],
                            'chart':      chart,
                            'version':    app['version'],
-                           'dirname':    dirname
+                           'dirname':    dirname,
+                           'source':     spec_source(fname)
                 }
                 if chart_repo:
                     if chart_repo not in repos:
@@ -85,11 +222,14 @@ def parse_helmsman(fname):
 #  - https://catalog.kpt.dev/render-helm-chart/v0.2/
 #  - https://github.com/GoogleContainerTools/kpt-functions-catalog/tree/master/functions/go/render-helm-chart
 def export_krmfmt(specs, outfname):
-    logging.debug('Parsed chart spec: {}'.format(pprint.pformat(specs)))
+    if debug_enabled():
+        import pprint
+        logging.debug('Parsed chart spec: {}'.format(pprint.pformat(specs)))
     #return export_krmfmt_0_1_0(specs, outfname)
     return export_krmfmt_0_2_0(specs, outfname)
 
 def export_krmfmt_0_2_0(specs, outfname):
+    import yaml
     with fopener(outfname) as fh:
         print('apiVersion: fn.kpt.dev/v1alpha1', file=fh)
         print('kind: RenderHelmChart', file=fh)
@@ -104,7 +244,8 @@ def export_krmfmt_0_2_0(specs, outfname):
         print('  templateOptions:', file=fh)
         for ka,kb in [('releaseName','rel_name'), ('namespace','namespace')]:
             print('    {}: {}'.format(ka, specs[0][kb]), file=fh)
-        if len(specs[0]['valuesfiles'])>0 or specs[0]['set']:
+        inline = spec_inline_values(specs[0])
+        if len(specs[0]['valuesfiles'])>0 or inline:
             print('    values:', file=fh)
         if len(specs[0]['valuesfiles'])==1:
             print('      valuesFile: {}'.format(specs[0]['valuesfiles'][0]), file=fh)
@@ -112,13 +253,14 @@ def export_krmfmt_0_2_0(specs, outfname):
             print('      valuesFiles:', file=fh)
             for fn in specs[0]['valuesfiles']:
                 print('      - {}'.format(fn), file=fh)
-        if specs[0]['set']:
+        if inline:
             print('      valuesInline:', file=fh)
-            y = yaml.dump(specs[0]['set'], default_flow_style=False)
+            y = yaml.dump(inline, default_flow_style=False)
             for ln in str(y).split('\n'):
                 print('        '+ln, file=fh)
 
 def export_krmfmt_0_1_0(specs, outfname):
+    import yaml
     with fopener(outfname) as fh:
         print('helmCharts:', file=fh)
         prefix = '- '
@@ -132,142 +274,1043 @@ def export_krmfmt_0_1_0(specs, outfname):
             print('  valuesFiles:', file=fh) # This is an extension - format does not support lists
             for fn in specs[0]['valuesfiles']:
                 print('  - {}'.format(fn), file=fh)
-        if specs[0]['set']:
+        inline = spec_inline_values(specs[0])
+        if inline:
             print('  valuesInline:', file=fh)
-            y = yaml.dump(specs[0]['set'], default_flow_style=False)
+            y = yaml.dump(inline, default_flow_style=False)
             for ln in str(y).split('\n'):
                 print('    '+ln, file=fh)
 
 # https://github.com/GoogleContainerTools/kpt-functions-catalog/tree/master/functions/go/render-helm-chart
 # https://catalog.kpt.dev/render-helm-chart/v0.1/
 def parse_krm(fname):
-    specs = []
-    repo = {}
     dirname = os.path.dirname(fname)
     if dirname == '':
         dirname = '.'
     logging.debug("Loading KRM spec '{}'. Dirname '{}'".format(fname, dirname))
     with fopener_read(fname) as fs:
-        apps = yaml.load(fs, Loader=yaml.FullLoader)
-        if 'kind' in apps and apps['kind'] == 'ResourceList':
-            # For KRM functions, the Helm chart spec is embedded in 'functionConfig'
-            apps = apps['functionConfig']
-        for app in apps.get('helmCharts', []):
-            if 'templateOptions' in app and 'chartArgs' in app:   # v0.2.0 format
-                version = '0.2.0'
-                templateOptions = app['templateOptions']
-                chartArgs = app['chartArgs']
-                new_app = {'rel_name':   templateOptions['releaseName'],
-                           'namespace':  templateOptions['namespace'],
-                           'chart':      chartArgs['name'],
-                           'repository': chartArgs['repo'],
-                           'version':    chartArgs['version'],
-                           'dirname':    dirname,
-                           'valuesfiles': [],
-                           'set':        {}
-                }
-                if 'apiVersions' in templateOptions:
-                    new_app['apiVersions'] = templateOptions['apiVersions']
-                if 'values' in templateOptions:
-                    values = templateOptions['values']
-                    new_app['set'] = values.get('valuesInline', dict())
-                    if 'valuesFile' in values:
-                        new_app['valuesfiles'] += [values.get('valuesFile')]
-                    new_app['valuesfiles'] += values.get('valuesFiles', [])
-                specs.append(new_app)
-            else:  # assume v0.1.0 format
-                version = '0.1.0'
-                new_app = {'rel_name':   app['releaseName'],
-                           'namespace':  app['namespace'],
-                           'chart':      app['name'],
-                           'repository': app['repo'],
-                           'version':    app['version'],
-                           'dirname':    dirname,
-                           'valuesfiles': []
-                }
-                new_app['set'] = app.get('valuesInline', dict())
-                if 'valuesFile' in app:
-                    new_app['valuesfiles'] += [app.get('valuesFile')]
-                new_app['valuesfiles'] += app.get('valuesFiles', []) # Extension, v0.1.0 format does not support lists
-                specs.append(new_app)
-    return specs,version
+        return parse_krm_stream(fs, dirname, spec_source(fname))
 
-def parse_flux(fname):
+def parse_krm_stream(fs, dirname, source='-'):
+    import yaml
     specs = []
-    repo = {}
-    logging.debug("Loading Flux spec '{}'".format(fname))
-    with open(fname, 'r') as fs:
-        app = yaml.load(fs)
-        meta = app['metadata']
-        spec = app['spec']
-        chart = spec['chart']
+    version = None
+    apps = yaml.load(fs, Loader=yaml.FullLoader)
+    if 'kind' in apps and apps['kind'] == 'ResourceList':
+        # For KRM functions, the Helm chart spec is embedded in 'functionConfig'
+        apps = apps['functionConfig']
+    for app in apps.get('helmCharts', []):
+        if 'templateOptions' in app and 'chartArgs' in app:   # v0.2.0 format
+            version = '0.2.0'
+            templateOptions = app['templateOptions']
+            chartArgs = app['chartArgs']
+            new_app = {'rel_name':   templateOptions['releaseName'],
+                       'namespace':  templateOptions['namespace'],
+                       'chart':      chartArgs['name'],
+                       'repository': chartArgs['repo'],
+                       'version':    chartArgs['version'],
+                       'dirname':    dirname,
+                       'source':     source,
+                       'valuesfiles': [],
+                       'values':     {}
+            }
+            if 'apiVersions' in templateOptions:
+                new_app['apiVersions'] = templateOptions['apiVersions']
+            if 'values' in templateOptions:
+                values = templateOptions['values']
+                new_app['values'] = values.get('valuesInline', dict())
+                if 'valuesFile' in values:
+                    new_app['valuesfiles'] += [values.get('valuesFile')]
+                new_app['valuesfiles'] += values.get('valuesFiles', [])
+            specs.append(new_app)
+        else:  # assume v0.1.0 format
+            version = '0.1.0'
+            new_app = {'rel_name':   app['releaseName'],
+                       'namespace':  app['namespace'],
+                       'chart':      app['name'],
+                       'repository': app['repo'],
+                       'version':    app['version'],
+                       'dirname':    dirname,
+                       'source':     source,
+                       'valuesfiles': []
+            }
+            new_app['values'] = app.get('valuesInline', dict())
+            if 'valuesFile' in app:
+                new_app['valuesfiles'] += [app.get('valuesFile')]
+            new_app['valuesfiles'] += app.get('valuesFiles', []) # Extension, v0.1.0 format does not support lists
+            specs.append(new_app)
+    return specs,version
+
+FLUX_KINDS = ['HelmRelease', 'HelmRepository']
+
+def flux_documents(fname):
+    '''Iterate over the Flux HelmRelease and HelmRepository objects of a multi-document file'''
+    import yaml
+    with open(fname, 'r') as fh:
+        text = fh.read()
+    # Most files of a cluster directory hold other resources, avoid parsing them
+    if not any([kind in text for kind in FLUX_KINDS]):
+        return
+    for doc in yaml.load_all(text, Loader=yaml_loader()):
+        if isinstance(doc, dict) and doc.get('kind') in FLUX_KINDS:
+            yield doc
+
+def flux_files(dirname):
+    '''Iterate over YAML files below dirname, in a stable order and skipping hidden directories'''
+    for root, dirs, files in os.walk(dirname):
+        dirs[:] = sorted([d for d in dirs if not d.startswith('.')])
+        for fn in sorted(files):
+            if fn.endswith('.yaml') or fn.endswith('.yml'):
+                yield os.path.join(root, fn)
+
+def flux_release(app, repos, dirname, source):
+    '''Return spec of a HelmRelease, charts referenced with sourceRef are resolved using the HelmRepository index repos'''
+    meta = app['metadata']
+    spec = app['spec']
+    chart = spec['chart']
+    rid = '{}/{}'.format(meta.get('namespace', 'default'), meta['name'])
+    if 'spec' in chart:
+        # Flux v2, chart from a source object
+        chart_spec = chart['spec']
+        ref = chart_spec.get('sourceRef', {})
+        if ref.get('kind', 'HelmRepository') != 'HelmRepository':
+            logging.warning('Skipping HelmRelease {}, charts from {} are not supported'.format(rid, ref.get('kind')))
+            return None
+        key = (ref.get('namespace') or meta.get('namespace', 'default'), ref.get('name'))
+        if key not in repos:
+            raise ParseError('HelmRepository {}/{} referenced by HelmRelease {} not found'.format(key[0], key[1], rid))
+        target = spec.get('targetNamespace')
+        new_app = {'rel_name':   spec.get('releaseName') or (target+'-'+meta['name'] if target else meta['name']),
+                   'namespace':  target or meta.get('namespace', 'default'),
+                   'chart':      chart_spec['chart'],
+                   'version':    chart_spec.get('version', '*'),
+                   'repository': repos[key]}
+        if chart_spec.get('valuesFiles') or chart_spec.get('valuesFile'):
+            logging.warning('HelmRelease {}: Chart values files are not supported, ignored'.format(rid))
+    else:
+        # Flux v1, chart given inline
         new_app = {'rel_name':  spec['releaseName'],
-                   'namespace': meta['namespace'],
-                   'valuesfiles': []
-        }
+                   'namespace': meta['namespace']}
         chart_keys = ['repository', 'name',  'version']
         new_keys =   ['repository', 'chart', 'version']
         if set(chart_keys).issubset(chart.keys()):
             for ck,ckn in zip(chart_keys, new_keys):
                 new_app[ckn] = chart[ck]
-        new_app['set'] = spec.get('values', dict())
-        specs.append(new_app)
+    if spec.get('valuesFrom'):
+        logging.warning('HelmRelease {}: valuesFrom is not supported, ignored'.format(rid))
+    new_app['dirname'] = dirname
+    new_app['source'] = source
+    new_app['valuesfiles'] = []
+    new_app['values'] = spec.get('values') or dict()
+    return new_app
+
+def parse_flux(fnames, dirs=()):
+    '''Parse HelmRelease objects of files and of all YAML files below dirs in one pass. Files below dirs which are not valid YAML are skipped'''
+    import yaml
+    releases = []
+    repos = {}      # (namespace, name) -> repository URL
+    sources = [(fn, False) for fn in fnames] + [(fn, True) for d in dirs for fn in flux_files(d)]
+    for fname, scanned in sources:
+        logging.debug("Loading Flux spec '{}'".format(fname))
+        try:
+            docs = list(flux_documents(fname))
+        except yaml.YAMLError as e:
+            if not scanned:
+                raise
+            logging.warning("Skipping '{}', not valid YAML: {}".format(fname, e))
+            continue
+        for doc in docs:
+            meta = doc.get('metadata') or {}
+            if doc['kind'] == 'HelmRepository':
+                repos[(meta.get('namespace', 'default'), meta.get('name'))] = (doc.get('spec') or {}).get('url')
+            else:
+                releases.append((doc, os.path.dirname(fname) or '.', spec_source(fname)))
+    logging.info('Found {} HelmReleases and {} HelmRepositories in {} files'.format(len(releases), len(repos), len(sources)))
+    specs = []
+    for doc, dirname, source in releases:
+        new_app = flux_release(doc, repos, dirname, source)
+        if new_app:
+            specs.append(new_app)
     return specs
 
 # Work-around for '=' as unquoted string
 # https://github.com/yaml/pyyaml/issues/89
 # https://github.com/prometheus-operator/prometheus-operator/pull/4897
-class PatchedFullLoader(yaml.FullLoader):
-    yaml_implicit_resolvers = yaml.FullLoader.yaml_implicit_resolvers.copy()
-    yaml_implicit_resolvers.pop("=")
-
-def yaml2dict(app):
-    res_out = []
-    for res in app.split('\n---\n'):
-        res = string.Template(res).safe_substitute(os.environ)
-        res = yaml.load(res, Loader=PatchedFullLoader)
+# Use the libyaml based loader when PyYAML was built with it
+@functools.lru_cache(maxsize=None)
+def yaml_loader():
+    import yaml
+    class PatchedFullLoader(getattr(yaml, 'CFullLoader', yaml.FullLoader)):
+        yaml_implicit_resolvers = yaml.FullLoader.yaml_implicit_resolvers.copy()
+        yaml_implicit_resolvers.pop("=")
+    return PatchedFullLoader
+
+# Use the libyaml based dumper when PyYAML was built with it
+@functools.lru_cache(maxsize=None)
+def yaml_dumper():
+    import yaml
+    return getattr(yaml, 'CDumper', yaml.Dumper)
+
+def emit_resources(fh, res):
+    '''Write resources as a stream of YAML documents'''
+    import yaml
+    dumper = yaml_dumper()
+    for r in res:
+        if isinstance(r, RawResource):
+            fh.write(r.text)
+        else:
+            yaml.dump(r, fh, Dumper=dumper)
+        fh.write('\n---\n')
+
+def emit_resource_list(fh, res):
+    '''Write resources as a KRM function ResourceList. Items are emitted one at a time'''
+    import yaml
+    fh.write('apiVersion: config.kubernetes.io/v1\n')
+    fh.write('kind: ResourceList\n')
+    dumper = yaml_dumper()
+    empty = True
+    for r in res:
+        if empty:
+            fh.write('items:\n')
+            empty = False
+        if isinstance(r, RawResource):
+            # Indent the original text as a sequence item
+            fh.write('- '+r.text[:-1].replace('\n', '\n  ')+'\n')
+        else:
+            yaml.dump([r], fh, Dumper=dumper)
+    if empty:
+        fh.write('items: []\n')
+    fh.write('\n')
+
+class EnvExpandingReader:
+    '''File-like wrapper substituting environment variables in text as it is read'''
+    def __init__(self, fh, env=None):
+        self.fh = fh
+        self.env = env if env is not None else os.environ
+
+    def read(self, size=-1):
+        data = self.fh.read(size)
+        if data and not data.endswith('\n'):
+            # Complete the line, variable references never span lines
+            data += self.fh.readline()
+        return string.Template(data).safe_substitute(self.env)
+
+class TeeReader:
+    '''File-like wrapper copying all text read into another file'''
+    def __init__(self, fh, out):
+        self.fh = fh
+        self.out = out
+
+    def read(self, size=-1):
+        data = self.fh.read(size)
+        self.out.write(data)
+        return data
+
+    def readline(self):
+        data = self.fh.readline()
+        self.out.write(data)
+        return data
+
+def yaml2dict(app, expand_env=True):
+    '''Iterate over resources in a YAML stream. App is either a string or a file-like object'''
+    import yaml
+    if isinstance(app, str):
+        app = io.StringIO(app)
+    if expand_env:
+        app = EnvExpandingReader(app)
+    for res in yaml.load_all(app, Loader=yaml_loader()):
         if res:
-            res_out.append(res)
-    return res_out
+            yield res
+
+RAW_READ_SIZE = 64*1024
+
+@functools.lru_cache(maxsize=None)
+def raw_patterns():
+    '''Patterns for a block mapping key line, with a plain or quoted key, and a quoted scalar value'''
+    import re
+    key = re.compile(r'''(?:"([^"\\]*)"|'([^']*)'|([^\s"'#&*!|>%@`{}\[\],?:-][^:#]*?|-[^\s:#][^:#]*?))[ \t]*:(?:[ \t]+(.*))?$''')
+    quoted = re.compile(r'''(?:"([^"\\]*)"|'((?:[^']|'')*)')[ \t]*(?:#.*)?$''')
+    return key, quoted
+
+def raw_key(m):
+    return next(g for g in m.groups()[:3] if g is not None)
+
+def raw_scalar(value):
+    '''Value of a single line scalar, None for null. Raises ValueError for values needing a YAML parser'''
+    if not value or value[0] == '#':
+        return None
+    if value[0] in '"\'':
+        m = raw_patterns()[1].match(value)
+        if not m:
+            raise ValueError(value)
+        return m.group(1) if m.group(1) is not None else m.group(2).replace("''", "'")
+    if value[0] in '&*!|>{}[]%@`,' or value[:2] in ['- ', '? ', ': ']:
+        raise ValueError(value)
+    i = value.find(' #')
+    if i >= 0:
+        value = value[:i].rstrip()
+    if ': ' in value or value.endswith(':'):
+        raise ValueError(value)
+    if value in ['null', 'Null', 'NULL', '~']:
+        return None
+    return value
+
+def raw_header(lines):
+    '''Scan the lines of a YAML document for apiVersion, kind and the name, namespace and Helm hook annotation
+    of metadata. Returns None if the document is not a block mapping simple enough to scan'''
+    key_re = raw_patterns()[0]
+    header = {}
+    meta = None
+    section = None          # Top-level key of the current line
+    meta_indent = None      # Indentation of metadata keys
+    anno_indent = None      # Indentation of annotations, None if not in annotations
+    in_anno = False
+    scalar_indent = None    # Indentation of the last scalar scanned, deeper lines would continue it
+    try:
+        for line in lines:
+            if line[:1] == ' ' and section != 'metadata' and scalar_indent is None:
+                continue
+            s = line.strip()
+            if not s or s[0] == '#':
+                continue
+            indent = len(line)-len(line.lstrip(' '))
+            if line[indent] == '\t' or (scalar_indent is not None and indent > scalar_indent):
+                return None
+            scalar_indent = None
+            if (s == '-' or s.startswith('- ')) and (indent == 0 or indent == meta_indent):
+                # Item of a sequence not indented relative to its key, e.g. rules of a Role
+                continue
+            if indent == 0:
+                m = key_re.match(s)
+                if not m:
+                    return None
+                section = raw_key(m)
+                if section in ['apiVersion', 'kind']:
+                    header[section] = raw_scalar(m.group(4))
+                    scalar_indent = 0
+                elif section == 'metadata':
+                    if raw_scalar(m.group(4)) is not None:
+                        return None
+                    meta = header['metadata'] = {}
+                    meta_indent = None
+                    in_anno = False
+                elif section == '<<':
+                    return None
+                continue
+            if section != 'metadata':
+                continue
+            if meta_indent is None:
+                meta_indent = indent
+            if indent < meta_indent:
+                return None
+            if indent == meta_indent:
+                m = key_re.match(s)
+                if not m:
+                    return None
+                key = raw_key(m)
+                in_anno = False
+                if key in ['name', 'namespace']:
+                    meta[key] = raw_scalar(m.group(4))
+                    scalar_indent = indent
+                elif key == 'annotations':
+                    value = m.group(4) or ''
+                    if value.split(' #')[0].strip() not in ['', '{}']:
+                        raw_scalar(value)
+                    in_anno = True
+                    anno_indent = None
+                elif key == '<<':
+                    return None
+                continue
+            if in_anno:
+                if anno_indent is None:
+                    anno_indent = indent
+                if indent == anno_indent:
+                    m = key_re.match(s)
+                    if not m:
+                        return None
+                    key = raw_key(m)
+                    if key == 'helm.sh/hook':
+                        meta['annotations'] = {key: raw_scalar(m.group(4))}
+                        scalar_indent = indent
+                    elif key == '<<':
+                        return None
+    except ValueError:
+        return None
+    if not header:
+        return None
+    return header
+
+class RawResource:
+    '''A resource kept as the text Helm rendered it, see --raw-passthrough. get() serves apiVersion, kind and
+    metadata, with only name, namespace and the Helm hook annotation, from a scan of the text. Other fields and
+    data parse the text'''
+    __slots__ = ['text', 'header', '_data']
+
+    def __init__(self, text, header):
+        self.text = text
+        self.header = header
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            import yaml
+            self._data = yaml.load(self.text, Loader=yaml_loader())
+        return self._data
+
+    def get(self, key, default=None):
+        if key in self.header:
+            return self.header[key]
+        return self.data.get(key, default)
+
+    def __getitem__(self, key):
+        if key in self.header:
+            return self.header[key]
+        return self.data[key]
+
+    def keys(self):
+        return self.data.keys()
+
+def resource_data(r):
+    '''The full object of a resource, parsing raw resources'''
+    return r.data if isinstance(r, RawResource) else r
+
+def raw_documents(fh):
+    '''Iterate over the YAML documents of a stream as lists of lines. A separator line is part of the document following it'''
+    doc = []
+    tail = ''
+    while True:
+        data = fh.read(RAW_READ_SIZE)
+        if not data:
+            break
+        lines = (tail+data).split('\n')
+        tail = lines.pop()
+        for line in lines:
+            if doc and line.startswith('---') and line[3:4] in ['', ' ', '\t', '\r']:
+                yield doc
+                doc = []
+            doc.append(line)
+    if tail:
+        doc.append(tail)
+    if doc:
+        yield doc
+
+def raw_resources(app, expand_env=True):
+    '''Like yaml2dict, but resources are RawResource when their header can be scanned. Other documents are parsed'''
+    import yaml
+    if isinstance(app, str):
+        app = io.StringIO(app)
+    if expand_env:
+        app = EnvExpandingReader(app)
+    for lines in raw_documents(app):
+        body = lines
+        header = None
+        if lines[0].startswith('---'):
+            rest = lines[0][3:].strip()
+            # Content on the separator line, e.g. a tag, needs a parser
+            body = lines[1:] if not rest or rest[0] == '#' else None
+        if body is not None:
+            end = len(body)
+            while end and not body[end-1].strip():
+                end -= 1
+            body = body[:end]
+            header = raw_header(body)
+        if header is None:
+            res = yaml.load('\n'.join(lines), Loader=yaml_loader())
+            if res:
+                yield res
+            continue
+        yield RawResource('\n'.join(body)+'\n', header)
+
+# Path from a workload resource to its pod spec
+POD_SPEC_PATHS = {
+    'Pod': ['spec'],
+    'PodTemplate': ['template', 'spec'],
+    'Deployment': ['spec', 'template', 'spec'],
+    'StatefulSet': ['spec', 'template', 'spec'],
+    'DaemonSet': ['spec', 'template', 'spec'],
+    'ReplicaSet': ['spec', 'template', 'spec'],
+    'ReplicationController': ['spec', 'template', 'spec'],
+    'Job': ['spec', 'template', 'spec'],
+    'CronJob': ['spec', 'jobTemplate', 'spec', 'template', 'spec'],
+}
+
+def resource_images(res):
+    '''Return (container, image) of all containers of a workload resource'''
+    spec = res
+    for key in POD_SPEC_PATHS.get(res.get('kind'), [None]):
+        if not isinstance(spec, dict) or key not in spec:
+            return []
+        spec = spec[key]
+    if not isinstance(spec, dict):
+        return []
+    images = []
+    for ctype in ['initContainers', 'containers', 'ephemeralContainers']:
+        for c in spec.get(ctype) or []:
+            if c.get('image'):
+                images.append((c.get('name'), c['image']))
+    return images
 
 def list_images(app):
-    img_list = []
+    img_list = set()
     for res in app:
-        spec = None
-        if 'kind' in res and res['kind']=='Pod':
-            spec = res['spec']
-        if 'kind' in res and (res['kind']=='Deployment' or res['kind']=='StatefulSet' or res['kind']=='DaemonSet'):
-            spec = res['spec']['template']['spec']
-        containers = None
-        if spec:
-            containers = spec['containers']
-            if 'initContainers' in spec:
-                containers += spec['initContainers']
-        if containers:
-            logging.debug('Container list: {}'.format(containers))
-            imgs = [c['image'] for c in containers]
+        imgs = [img for _, img in resource_images(resource_data(res))]
+        if imgs and debug_enabled():
             logging.debug('Images from {} {}: {}'.format(res['kind'], res['metadata']['name'], imgs))
-            img_list += imgs
-
-    img_list_set = set(img_list)
-    img_out = (list(img_list_set))
+        img_list.update(imgs)
+    img_out = sorted(img_list)
     logging.debug('Images {}'.format(img_out))
     return img_out
 
-# Particularly needed for Helm2 which do not have a --repo argument on 'template'
-def helm_fetch_chart(app, args, chartdir, tmpdir):
-    logging.debug("Fetch : Using chart dir: '{}'".format(chartdir))
-    chart = '{}/{}-{}.tgz'.format(chartdir, app['chart'], app['version'])
-    if os.path.exists(chart):
-        logging.info('Using local chart: {}'.format(chart))
+@functools.lru_cache(maxsize=None)
+def default_file_mode():
+    '''Mode of files created with open(), i.e. 0o666 without the umask'''
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+@contextlib.contextmanager
+def atomic_write(fname, binary=False):
+    '''Open a uniquely named temporary file next to fname, renamed to fname when the block completes without an
+    exception. Concurrent writers of the same file never expose a partial file'''
+    import tempfile
+    dirname = os.path.dirname(fname) or '.'
+    fd, tmpname = tempfile.mkstemp(dir=dirname, prefix='.'+os.path.basename(fname)+'.')
+    try:
+        with open(fd, 'wb' if binary else 'w', encoding=None if binary else 'UTF-8') as fh:
+            yield fh
+        os.chmod(tmpname, default_file_mode())
+        os.replace(tmpname, fname)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmpname)
+        raise
+
+class ChartCache:
+    '''Persistent on-disk cache of chart archives keyed by repository, chart name and version
+
+    Entries are shared between concurrent runs through per-entry lock files. Each entry holds the
+    chart archive and a metadata file recording the archive sha256 digest. Archives are linked into
+    the directory of the run using them, such that eviction by another run does not remove them.
+    '''
+    def __init__(self, path):
+        self.path = os.path.join(path, 'charts')
+        os.makedirs(self.path, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._counter_lock = threading.Lock()
+
+    @staticmethod
+    def key(app):
+        import hashlib
+        ident = '\0'.join([app['repository'], app['chart'], str(app['version'])])
+        return hashlib.sha256(ident.encode('UTF-8')).hexdigest()
+
+    @contextlib.contextmanager
+    def locked(self, key, blocking=True):
+        '''Lock an entry. The lock file may be removed while locked, e.g. by eviction'''
+        import fcntl
+        lockfile = os.path.join(self.path, key+'.lock')
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        while True:
+            with open(lockfile, 'a') as fh:
+                try:
+                    fcntl.flock(fh, flags)
+                except BlockingIOError:
+                    yield False
+                    return
+                try:
+                    # Retry if the lock file was removed while waiting for the lock
+                    try:
+                        current = os.stat(lockfile).st_ino == os.fstat(fh.fileno()).st_ino
+                    except FileNotFoundError:
+                        current = False
+                    if current:
+                        yield True
+                        return
+                finally:
+                    fcntl.flock(fh, fcntl.LOCK_UN)
+
+    @staticmethod
+    def link(src, dest):
+        '''Hard link src as dest, copying if linking is not possible'''
+        import shutil
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(dest)
+        try:
+            os.link(src, dest)
+        except OSError:
+            shutil.copyfile(src, dest)
+
+    def _count(self, hit):
+        with self._counter_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def fetch(self, app, pull, dest):
+        '''Link cached chart archive as dest and return its digest. On a cache miss, pull(destdir) is called to fetch the chart'''
+        import json
+        import shutil
+        import tempfile
+        key = self.key(app)
+        entry = os.path.join(self.path, key)
+        archive = os.path.join(entry, 'chart.tgz')
+        metafile = os.path.join(entry, 'meta.json')
+        with self.locked(key):
+            if os.path.exists(archive) and os.path.exists(metafile):
+                with open(metafile, 'r') as fh:
+                    meta = json.load(fh)
+                os.utime(archive)   # Last-use time for eviction
+                logging.debug('Chart cache hit for {}/{}-{}: {}'.format(app['repository'], app['chart'], app['version'], entry))
+                self._count(True)
+                self.link(archive, dest)
+                return meta['digest']
+
+            logging.debug('Chart cache miss for {}/{}-{}'.format(app['repository'], app['chart'], app['version']))
+            self._count(False)
+            pulldir = tempfile.mkdtemp(dir=self.path, prefix='.pull-')
+            try:
+                chart = pull(pulldir)
+                digest = file_digest(chart)
+                os.makedirs(entry, exist_ok=True)
+                os.replace(chart, archive)
+                meta = {'repository': app['repository'], 'chart': app['chart'], 'version': str(app['version']),
+                        'digest': digest, 'fetched': time.time()}
+                with atomic_write(metafile) as fh:
+                    json.dump(meta, fh)
+            finally:
+                shutil.rmtree(pulldir, ignore_errors=True)
+            self.link(archive, dest)
+        return digest
+
+    def entries(self):
+        '''Return last-use time, size and key of all entries'''
+        entries = []
+        for key in os.listdir(self.path):
+            archive = os.path.join(self.path, key, 'chart.tgz')
+            if os.path.exists(archive):
+                st = os.stat(archive)
+                entries.append((st.st_mtime, st.st_size, key))
+            elif key.endswith('.lock') and not os.path.exists(os.path.join(self.path, key[:-len('.lock')])):
+                # Lock of an entry already evicted or never completed
+                with self.locked(key[:-len('.lock')], blocking=False) as locked:
+                    if locked:
+                        os.remove(os.path.join(self.path, key))
+        return entries
+
+    def remove(self, key):
+        '''Remove entry unless in use by another run, returning whether it was removed'''
+        import shutil
+        with self.locked(key, blocking=False) as locked:
+            if locked:
+                logging.debug('Evicting chart cache entry {}'.format(key))
+                shutil.rmtree(os.path.join(self.path, key), ignore_errors=True)
+                os.remove(os.path.join(self.path, key+'.lock'))
+            return locked
+
+class RenderCache:
+    '''Persistent cache of 'helm template' output keyed by chart digest and all inputs affecting the output'''
+    def __init__(self, path):
+        self.path = os.path.join(path, 'renders')
+        os.makedirs(self.path, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._counter_lock = threading.Lock()
+        self._helm_version = None
+
+    def helm_version(self, args):
+        '''Version reported by helm, once per run'''
+        import subprocess
+        with self._counter_lock:
+            if self._helm_version is None:
+                self._helm_version = subprocess.check_output(helm_cmd(args) + ['version', '--short'],
+                                                             universal_newlines=True).strip()
+            return self._helm_version
+
+    def key(self, app, args, digest, values, inline):
+        import hashlib
+        import json
+        h = hashlib.sha256()
+        # Output of the same chart may differ between helm versions
+        inputs = {'helm': self.helm_version(args), 'digest': digest,
+                  'rel_name': app['rel_name'], 'namespace': app['namespace'],
+                  'kube_version': args.kube_version, 'api_versions': args.api_versions,
+                  'inline': inline, 'values': values}
+        h.update(json.dumps(inputs, sort_keys=True, default=str).encode('UTF-8'))
+        return h.hexdigest()
+
+    def lookup(self, key):
+        '''Return cached output opened for reading or None on a cache miss. The file remains readable if evicted by another run'''
+        try:
+            fh = open(os.path.join(self.path, key+'.yaml'), 'r')
+        except FileNotFoundError:
+            fh = None
+        else:
+            os.utime(fh.fileno())     # Last-use time for eviction
+        with self._counter_lock:
+            if fh:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return fh
+
+    def writer(self, key):
+        '''File handle for storing output. The entry is only added to the cache if no exception is raised'''
+        return atomic_write(os.path.join(self.path, key+'.yaml'))
+
+    def purge(self):
+        import shutil
+        logging.info("Purging render cache '{}'".format(self.path))
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.makedirs(self.path, exist_ok=True)
+
+    def entries(self):
+        '''Return last-use time, size and filename of all entries'''
+        entries = []
+        for fn in os.listdir(self.path):
+            if fn.endswith('.yaml') and not fn.startswith('.'):
+                with contextlib.suppress(FileNotFoundError):
+                    st = os.stat(os.path.join(self.path, fn))
+                    entries.append((st.st_mtime, st.st_size, fn))
+        return entries
+
+    def remove(self, fn):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(os.path.join(self.path, fn))
+        return True
+
+def evict_caches(caches, max_size=0, max_age=0):
+    '''Remove entries not used within max_age seconds, then least recently used entries until the combined
+    size of all caches is below max_size bytes'''
+    if not max_size and not max_age:
+        return
+    entries = []
+    for cache in caches:
+        entries.extend([(mtime, size, name, cache) for mtime, size, name in cache.entries()])
+    entries.sort(key=lambda e: e[:3])
+    total = sum([e[1] for e in entries])
+    now = time.time()
+    for mtime, size, name, cache in entries:
+        expired = max_age and now-mtime > max_age
+        if not expired and (not max_size or total <= max_size):
+            continue
+        if cache.remove(name):
+            total -= size
+
+class HTTPPool:
+    '''Persistent HTTP connections, reused for requests to the same host. Proxies are taken from the environment'''
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+        self._idle = {}     # (scheme, netloc) -> [(connection, absolute URL requests)]
+        self._lock = threading.Lock()
+
+    def _connect(self, u):
+        import http.client
+        import urllib.parse
+        import urllib.request
+        cls = http.client.HTTPSConnection if u.scheme == 'https' else http.client.HTTPConnection
+        proxy = urllib.request.getproxies().get(u.scheme)
+        if proxy and not urllib.request.proxy_bypass(u.hostname):
+            p = urllib.parse.urlsplit(proxy)
+            if u.scheme == 'https':
+                conn = http.client.HTTPSConnection(p.hostname, p.port, timeout=self.timeout)
+                conn.set_tunnel(u.hostname, u.port)
+                return conn, False
+            return http.client.HTTPConnection(p.hostname, p.port, timeout=self.timeout), True
+        return cls(u.hostname, u.port, timeout=self.timeout), False
+
+    def fetch(self, url, fh, redirects=5):
+        '''GET url and write the response body to binary file fh'''
+        import http.client
+        import urllib.parse
+        for _ in range(redirects+1):
+            u = urllib.parse.urlsplit(url)
+            if u.scheme not in ['http', 'https']:
+                raise FetchError("Unsupported URL '{}'".format(url))
+            key = (u.scheme, u.netloc)
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                conn, absolute = idle.pop() if idle else (None, False)
+            # An idle connection may have been closed by the server, then retry once with a new connection
+            for attempt in [0, 1]:
+                if not conn:
+                    conn, absolute = self._connect(u)
+                path = url if absolute else urllib.parse.urlunsplit(('', '', u.path or '/', u.query, ''))
+                try:
+                    conn.request('GET', path, headers={'User-Agent': 'helm2yaml'})
+                    resp = conn.getresponse()
+                    break
+                except (OSError, http.client.HTTPException) as e:
+                    conn.close()
+                    conn = None
+                    if attempt:
+                        raise FetchError("Fetching '{}': {}".format(url, e))
+            try:
+                if resp.status == 200:
+                    for chunk in iter(lambda: resp.read(1024*1024), b''):
+                        fh.write(chunk)
+                else:
+                    resp.read()
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                raise FetchError("Fetching '{}': {}".format(url, e))
+            if resp.will_close:
+                conn.close()
+            else:
+                with self._lock:
+                    self._idle[key].append((conn, absolute))
+            if resp.status == 200:
+                return
+            location = resp.getheader('Location')
+            if resp.status not in [301, 302, 303, 307, 308] or not location:
+                raise FetchError("Fetching '{}': HTTP status {}".format(url, resp.status))
+            url = urllib.parse.urljoin(url, location)
+        raise FetchError("Fetching '{}': Too many redirects".format(url))
+
+    def close(self):
+        with self._lock:
+            for conns in self._idle.values():
+                for conn, absolute in conns:
+                    conn.close()
+            self._idle = {}
+
+# Helm chart versions are semantic versions, selected by exact version or a constraint, e.g. '^1.2' or
+# '>=1.0 <2.0 || 3.x'. Constraints follow the syntax of the semver library used by Helm
+VERSION_OPERATORS = r'!=|>=|=>|<=|=<|>|<|=|~>|~|\^'
+
+@functools.lru_cache(maxsize=None)
+def semver_patterns():
+    import re
+    version = re.compile(r'^v?(\d+)\.(\d+)\.(\d+)(?:-([0-9A-Za-z.-]+))?(?:\+[0-9A-Za-z.-]+)?$')
+    part = r'(\d+|[xX*])'
+    term = re.compile(r'^(' + VERSION_OPERATORS + r')?v?' + part + r'(?:\.' + part + r')?(?:\.' + part + r')?'
+                      r'(?:-([0-9A-Za-z.-]+))?(?:\+[0-9A-Za-z.-]+)?$')
+    return version, term
+
+def prerelease_key(pre):
+    return tuple([(0, int(i), '') if i.isdigit() else (1, 0, i) for i in pre.split('.')]) if pre else ()
+
+def semver_key(version):
+    '''Sort key of a semantic version, None if not a complete version'''
+    m = semver_patterns()[0].match(str(version))
+    if not m:
+        return None
+    pre = m.group(4)
+    return (int(m.group(1)), int(m.group(2)), int(m.group(3)), 0 if pre else 1, prerelease_key(pre))
+
+def version_term(text):
+    '''Return predicate on semver_key of a single constraint term, e.g. '~1.2', and whether it has a pre-release'''
+    m = semver_patterns()[1].match(text)
+    if not m:
+        raise ParseError("Invalid chart version constraint '{}'".format(text))
+    op = m.group(1) or '='
+    nums = []
+    for p in m.group(2, 3, 4):
+        if p is None or p in 'xX*':
+            break
+        nums.append(int(p))
+    pre = m.group(5)
+    base = tuple(nums + [0]*(3-len(nums)))
+    low = base + (0 if pre else 1, prerelease_key(pre)) if len(nums) == 3 else base + (0, ())
+    # Lowest version above all versions matching the parts given, None if unbounded
+    if len(nums) == 0:
+        high = None
+    elif len(nums) == 1:
+        high = (nums[0]+1, 0, 0, 0, ())
+    elif len(nums) == 2:
+        high = (nums[0], nums[1]+1, 0, 0, ())
     else:
-        if app['repository'].startswith('oci://'):
-            cmd = '{} pull {}/{} --destination {} --version {}'.format(args.helm_bin, app['repository'], app['chart'], chartdir, app['version'])
+        high = None
+    if op in ['=', '!=']:
+        match = (lambda v: v == low) if len(nums) == 3 else (lambda v: v >= low and (high is None or v < high))
+        return (match if op == '=' else lambda v: not match(v)), bool(pre)
+    if op == '>':
+        return ((lambda v: v > low) if len(nums) == 3 else (lambda v: high is not None and v >= high)), bool(pre)
+    if op in ['>=', '=>']:
+        return (lambda v: v >= low), bool(pre)
+    if op == '<':
+        return (lambda v: v < low), bool(pre)
+    if op in ['<=', '=<']:
+        return ((lambda v: v <= low) if len(nums) == 3 else (lambda v: high is None or v < high)), bool(pre)
+    if op in ['~', '~>']:
+        upper = (base[0], base[1]+1, 0, 0, ()) if len(nums) >= 2 else high
+    else:   # '^', the left-most non-zero part is fixed
+        if len(nums) == 0:
+            upper = None
+        elif nums[0] > 0 or len(nums) == 1:
+            upper = (nums[0]+1, 0, 0, 0, ())
+        elif nums[1] > 0 or len(nums) == 2:
+            upper = (0, nums[1]+1, 0, 0, ())
         else:
-            cmd = '{} pull --repo {} {} --destination {} --version {}'.format(args.helm_bin, app['repository'], app['chart'], chartdir, app['version'])
-        logging.debug('Helm command: {}'.format(cmd))
-        out = subprocess.check_output(cmd, shell=True)
-        logging.debug(out)
+            upper = (0, 0, nums[2]+1, 0, ())
+    return (lambda v: v >= low and (upper is None or v < upper)), bool(pre)
+
+def version_constraint(text):
+    '''Return predicate on semver_key of versions matching a constraint. Pre-releases only match constraints
+    with a pre-release'''
+    import re
+    alternatives = []
+    prerelease = False
+    for group in str(text).split('||'):
+        # Hyphen ranges, e.g. '1.2 - 1.4', and spaces between operator and version
+        group = re.sub(r'\s+-\s+', ' - ', group.strip())
+        group = re.sub(r'(' + VERSION_OPERATORS + r')\s+', r'\1', group)
+        words = [w for w in re.split(r'[\s,]+', group) if w]
+        terms = []
+        while words:
+            if len(words) >= 3 and words[1] == '-':
+                words[:3] = ['>='+words[0], '<='+words[2]]
+            match, pre = version_term(words.pop(0))
+            terms.append(match)
+            prerelease = prerelease or pre
+        if not terms:
+            raise ParseError("Invalid chart version constraint '{}'".format(text))
+        alternatives.append(terms)
+    return lambda v: (prerelease or v[3] == 1) and any([all([t(v) for t in terms]) for terms in alternatives])
+
+def resolve_version(constraint, versions):
+    '''Return the newest of versions matching constraint, None if none match'''
+    match = version_constraint(constraint)
+    candidates = [(semver_key(v), v) for v in versions]
+    candidates = [(k, v) for k, v in candidates if k and match(k)]
+    return max(candidates)[1] if candidates else None
+
+class RepoIndex:
+    '''Resolves charts of classic Helm repositories to archive URLs using the repository index.yaml
+
+    Each index is fetched and parsed once per run and, with a cache dir, kept on disk in a compact form
+    for ttl seconds. Archives are downloaded directly, reusing connections.
+    '''
+    def __init__(self, cache_dir=None, ttl=0):
+        self.path = os.path.join(cache_dir, 'indexes') if cache_dir else None
+        self.ttl = ttl
+        self.http = HTTPPool()
+        self.indexes = {}   # repository -> {chart: {version: [urls, digest]}}, None if unavailable
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def reset(self):
+        '''Forget indexes fetched, e.g. between runs in server mode'''
+        self.indexes = {}
+
+    def index(self, repo):
+        '''Return charts of repository, None if the index is not available'''
+        import yaml
+        with self._lock:
+            lock = self._locks.setdefault(repo, threading.Lock())
+        with lock:
+            if repo not in self.indexes:
+                try:
+                    self.indexes[repo] = self.load(repo)
+                except (FetchError, OSError, ValueError, yaml.YAMLError) as e:
+                    logging.warning("Index of repository '{}' not available, using helm pull: {}".format(repo, e))
+                    self.indexes[repo] = None
+            return self.indexes[repo]
+
+    def load(self, repo):
+        import hashlib
+        import json
+        import tempfile
+        import yaml
+        cached = None
+        if self.path:
+            cached = os.path.join(self.path, hashlib.sha256(repo.encode('UTF-8')).hexdigest()+'.json')
+            try:
+                if time.time()-os.path.getmtime(cached) < self.ttl:
+                    with open(cached, 'r') as fh:
+                        charts = json.load(fh)
+                    logging.debug("Using cached index of repository '{}'".format(repo))
+                    return charts
+            except FileNotFoundError:
+                pass
+            except ValueError:
+                logging.warning("Ignoring corrupt cached index of repository '{}'".format(repo))
+        with METRICS.phase('index', repo):
+            with tempfile.TemporaryFile() as fh:
+                self.http.fetch(repo.rstrip('/')+'/index.yaml', fh)
+                fh.seek(0)
+                index = yaml.load(fh, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+            if not isinstance(index, dict) or not isinstance(index.get('entries'), dict):
+                raise ValueError('No chart entries in index')
+            charts = {}
+            for chart, versions in index['entries'].items():
+                charts[chart] = {str(v.get('version')): [v.get('urls') or [], v.get('digest')]
+                                 for v in versions or [] if isinstance(v, dict)}
+        logging.info("Loaded index of repository '{}' with {} charts".format(repo, len(charts)))
+        if cached:
+            os.makedirs(self.path, exist_ok=True)
+            with atomic_write(cached) as fh:
+                json.dump(charts, fh)
+        return charts
+
+    def versions(self, app):
+        '''Return versions of chart, None if the index is not available'''
+        charts = self.index(app['repository'])
+        if charts is None:
+            return None
+        return list(charts.get(app['chart'], {}).keys())
+
+    def resolve(self, app):
+        '''Return archive URL and digest of chart, None if not found in the repository index'''
+        import urllib.parse
+        versions = (self.index(app['repository']) or {}).get(app['chart'], {})
+        version = str(app['version'])
+        entry = versions.get(version)
+        if not entry:
+            # Versions are semver, with or without a 'v' prefix
+            entry = next((e for v, e in versions.items() if v.lstrip('v') == version.lstrip('v')), None)
+        if not entry or not entry[0]:
+            return None
+        urls, digest = entry
+        return urllib.parse.urljoin(app['repository'].rstrip('/')+'/', urls[0]), digest
+
+    def download(self, app, dest):
+        '''Download chart archive to dest. Returns False if the chart is not found in the repository index'''
+        resolved = self.resolve(app)
+        if not resolved:
+            return False
+        url, digest = resolved
+        logging.debug("Downloading chart {}-{} from '{}'".format(app['chart'], app['version'], url))
+        with METRICS.phase('download', app['rel_name']):
+            with open(dest+'.tmp', 'wb') as fh:
+                self.http.fetch(url, fh)
+        if digest and file_digest(dest+'.tmp') != digest:
+            os.remove(dest+'.tmp')
+            raise FetchError("Digest of '{}' does not match repository index".format(url))
+        os.replace(dest+'.tmp', dest)
+        return True
+
+def file_digest(fname):
+    import hashlib
+    h = hashlib.sha256()
+    with open(fname, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1024*1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def helm_pull_chart(app, args, chartdir, repo_index=None):
+    '''Pull chart into chartdir and return the path of the chart archive'''
+    import subprocess
+    chart = '{}/{}-{}.tgz'.format(chartdir, app['chart'], app['version'])
+    if repo_index and not app['repository'].startswith('oci://'):
+        try:
+            if repo_index.download(app, chart):
+                METRICS.count('chart_pulls', method='direct')
+                return chart
+        except FetchError as e:
+            logging.warning('Downloading chart {}-{} failed, using helm pull: {}'.format(app['chart'], app['version'], e))
+    METRICS.count('chart_pulls', method='helm')
+    if app['repository'].startswith('oci://'):
+        cmd = helm_cmd(args) + ['pull', '{}/{}'.format(app['repository'], app['chart'])]
+    else:
+        cmd = helm_cmd(args) + ['pull', '--repo', app['repository'], app['chart']]
+    cmd += ['--destination', chartdir, '--version', str(app['version'])]
+    logging.debug('Helm command: {}'.format(cmd))
+    with METRICS.phase('pull', app['rel_name']):
+        out = subprocess.check_output(cmd)
+    logging.debug(out)
 
     # Rename if chart does not follow common format as encoded in 'chart'
     if not os.path.exists(chart):
@@ -279,16 +1322,203 @@ def helm_fetch_chart(app, args, chartdir, tmpdir):
             os.rename(chartdir+"/"+options[0], chart)
         else:
             logging.info("Dont know which file to use to normalize chart name: {}".format(options))
+    return chart
 
-    cmd = 'tar -xzf {} --directory {}'.format(chart, tmpdir)
-    logging.debug('Tar command: {}'.format(cmd))
-    out = subprocess.check_output(cmd, shell=True)
-    logging.debug(out)
+# Particularly needed for Helm2 which do not have a --repo argument on 'template'
+def resolve_chart_version(app, repo_index):
+    '''Return release spec with a chart version constraint, e.g. Flux '*', resolved to a version using the
+    repository index. Without the index, the constraint is kept and resolved by helm pull'''
+    version = str(app['version'])
+    if semver_key(version) or not app.get('repository'):
+        return app
+    versions = None
+    if repo_index and not app['repository'].startswith('oci://'):
+        versions = repo_index.versions(app)
+    if versions is None:
+        logging.warning("Chart {} version '{}' is not resolved without the repository index, the chart is not cached".format(
+            app['chart'], version))
+        return app
+    if version in versions:
+        return app
+    resolved = resolve_version(version, versions)
+    if resolved is None:
+        raise ParseError("No version of chart {} in '{}' matches '{}'".format(app['chart'], app['repository'], version))
+    logging.info("Chart {} version '{}' resolved to {}".format(app['chart'], version, resolved))
+    return dict(app, version=resolved)
 
-    cmd = 'ls -laR {}'.format(tmpdir)
-    logging.debug('Post helm-fetch ls command: {}'.format(cmd))
-    out = subprocess.check_output(cmd, shell=True)
-    logging.debug(out)
+def helm_fetch_chart(app, args, chartdir, chart_cache=None, repo_index=None):
+    '''Fetch chart archive, returning its path and sha256 digest'''
+    logging.debug("Fetch : Using chart dir: '{}'".format(chartdir))
+    chart = '{}/{}-{}.tgz'.format(chartdir, app['chart'], app['version'])
+    digest = None
+    if os.path.exists(chart):
+        logging.info('Using local chart: {}'.format(chart))
+    elif chart_cache and semver_key(app['version']):
+        # Charts selected by a version constraint not resolved may change, see resolve_chart_version
+        digest = chart_cache.fetch(app, lambda destdir: helm_pull_chart(app, args, destdir, repo_index), chart)
+    else:
+        chart = helm_pull_chart(app, args, chartdir, repo_index)
+        digest = None
+    if not digest:
+        digest = file_digest(chart)
+    return chart, digest
+
+class ChartExtractor:
+    '''Extracts each distinct chart archive once into its own directory for use by all releases'''
+    def __init__(self, path, list_files=False):
+        self.path = path
+        self.list_files = list_files
+        self.charts = {}    # digest -> chart directory
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def extract(self, app, chart, digest):
+        '''Return directory of extracted chart archive'''
+        import tarfile
+        with self._lock:
+            lock = self._locks.setdefault(digest, threading.Lock())
+        with lock:
+            if digest in self.charts:
+                logging.debug('Reusing extracted chart {}: {}'.format(chart, self.charts[digest]))
+                return self.charts[digest]
+            destdir = os.path.join(self.path, digest)
+            with METRICS.phase('extract', app['rel_name']):
+                with tarfile.open(chart, 'r:*') as tf:
+                    members = tf.getmembers()
+                    topdirs = set([m.name.split('/')[0] for m in members])
+                    if hasattr(tarfile, 'data_filter'):
+                        tf.extractall(destdir, members=members, filter='data')
+                    else:
+                        tf.extractall(destdir, members=members)
+            # Charts are packaged with a single top-level directory, usually named as the chart
+            if app['chart'] in topdirs or len(topdirs) != 1:
+                topdir = app['chart']
+            else:
+                topdir = topdirs.pop()
+            chartdir = os.path.join(destdir, topdir)
+            logging.debug("Extracted chart {} into '{}'".format(chart, chartdir))
+            if self.list_files:
+                for root, dirs, files in os.walk(destdir):
+                    for fn in sorted(files):
+                        logging.info('Chart file: {}'.format(os.path.join(root, fn)))
+            self.charts[digest] = chartdir
+            return chartdir
+
+class RunState:
+    '''State shared by all releases rendered in a run'''
+    def __init__(self, args):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+        logging.debug("Run helm: Using tmp dir: '{}'".format(self.tmpdir))
+        if args.local_chart_path:
+            self.chartdir = args.local_chart_path
+            logging.debug("Run helm: Using chart dir: '{}'".format(self.chartdir))
+        else:
+            self.chartdir = None
+        self.fetch_lock = threading.Lock()
+        self.fetched = {}       # (repository, chart, version) -> (archive, digest)
+        self.values = {}        # values filename -> expanded content
+        self.values_files = {}  # values filename -> expanded copy
+        self._values_lock = threading.Lock()
+        self.rundir = None
+        self._locks = {}
+        self._lock = threading.Lock()
+        self.extractor = ChartExtractor(os.path.join(self.tmpdir, 'charts'), args.list_chart_files)
+
+        self.caches = []        # All caches in cache dir, evicted with a combined size limit
+        self.cache_max_size = args.cache_max_size*1024*1024
+        self.cache_max_age = args.cache_max_age*24*3600
+        if args.cache_dir:
+            self.chart_cache = ChartCache(args.cache_dir)
+            logging.debug("Run helm: Using chart cache: '{}'".format(self.chart_cache.path))
+            render_cache = RenderCache(args.cache_dir)
+            if args.purge_render_cache:
+                render_cache.purge()
+            self.caches = [self.chart_cache, render_cache]
+        else:
+            self.chart_cache = None
+        if args.cache_dir and not args.no_render_cache:
+            self.render_cache = render_cache
+        else:
+            self.render_cache = None
+        if args.no_repo_index:
+            self.repo_index = None
+        else:
+            self.repo_index = RepoIndex(args.cache_dir, args.repo_index_ttl)
+
+    def fetch_chart(self, app, args):
+        '''Fetch chart archive once per run, returning its path and digest'''
+        import tempfile
+        key = (app.get('repository'), app['chart'], str(app['version']))
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            if key not in self.fetched:
+                if self.chartdir:
+                    # Shared chart dir, serialize pulls to avoid clashing downloads and renames
+                    with self.fetch_lock:
+                        self.fetched[key] = helm_fetch_chart(app, args, self.chartdir, self.chart_cache, self.repo_index)
+                else:
+                    pulldir = tempfile.mkdtemp(dir=self.tmpdir, prefix='pull-')
+                    self.fetched[key] = helm_fetch_chart(app, args, pulldir, self.chart_cache, self.repo_index)
+            else:
+                logging.debug('Reusing fetched chart {}-{}'.format(app['chart'], app['version']))
+            return self.fetched[key]
+
+    def expand_values(self, fname):
+        '''Return content of values file with environment variables expanded, once per run'''
+        key = os.path.realpath(fname)
+        dst = self.values.get(key)
+        if dst is None:
+            with open(fname, 'r') as fh:
+                dst = string.Template(fh.read()).safe_substitute(os.environ)
+            if debug_enabled():
+                logging.debug('Env expanded values in file {}:\n{}'.format(fname, dst))
+            dst = self.values.setdefault(key, dst)
+        return dst
+
+    def values_file(self, fname):
+        '''Return path of the environment expanded copy of a values file, written once per run'''
+        key = os.path.realpath(fname)
+        with self._values_lock:
+            path = self.values_files.get(key)
+            if path is None:
+                path = os.path.join(self.rundir, 'values-{}-{}'.format(len(self.values_files), os.path.basename(fname)))
+                with open(path, 'w') as fh:
+                    fh.write(self.expand_values(fname))
+                self.values_files[key] = path
+        return path
+
+    def begin(self):
+        '''Prepare for a run. A state may be used for several runs, e.g. in server mode'''
+        import tempfile
+        self.values = {}    # Values files may change between runs
+        self.values_files = {}
+        # Charts selected by a version constraint may change between runs
+        self.fetched = {key: v for key, v in self.fetched.items() if semver_key(key[2])}
+        if self.repo_index:
+            self.repo_index.reset()     # Repositories may change between runs
+        self.rundir = tempfile.mkdtemp(dir=self.tmpdir, prefix='run-')
+
+    def finish(self):
+        '''Remove per-run files, report cache statistics and evict cache entries'''
+        import shutil
+        shutil.rmtree(self.rundir, ignore_errors=True)
+        if self.chart_cache:
+            logging.info('Chart cache: {} hits, {} misses'.format(self.chart_cache.hits, self.chart_cache.misses))
+            METRICS.count('cache_hits', self.chart_cache.hits, cache='chart')
+            METRICS.count('cache_misses', self.chart_cache.misses, cache='chart')
+        if self.render_cache:
+            logging.info('Render cache: {} hits, {} misses'.format(self.render_cache.hits, self.render_cache.misses))
+            METRICS.count('cache_hits', self.render_cache.hits, cache='render')
+            METRICS.count('cache_misses', self.render_cache.misses, cache='render')
+        evict_caches(self.caches, self.cache_max_size, self.cache_max_age)
+
+    def close(self):
+        import shutil
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+        if self.repo_index:
+            self.repo_index.http.close()
 
 def get_namespace_resource(args, app):
     return '''
@@ -298,79 +1528,441 @@ metadata:
   name: {name}
 '''.format(name=app['namespace'])
 
-def resource_filter(res, args):
-    helm_hook_anno = 'helm.sh/hook'
-    out = []
-    if args.hook_filter:
-        logging.debug("Hook filter using '{}'".format(args.hook_filter))
-        for r in res:
-            remove = False
-            if 'metadata' in r and 'annotations' in r['metadata']:
-                anno = r['metadata']['annotations']
-                logging.debug('Resource {}/{} annotations: {}'.format(r['kind'], r['metadata']['name'], anno))
-                if anno and helm_hook_anno in anno:
-                    if anno[helm_hook_anno] in args.hook_filter:
-                        logging.debug('Resource {}/{} annotation value {} matched filter, skipping'.format(r['kind'], r['metadata']['name'], anno[helm_hook_anno]))
-                        remove = True
-            if remove:
-                logging.info('Filtering resource {}/{}'.format(r['kind'], r['metadata']['name']))
-            else:
-                logging.debug('Resource {}/{} matched'.format(r['kind'], r['metadata']['name']))
-                out.append(r)
-    else:
-        return res
+# Automatic API upgrades, see --auto-api-upgrade. Extra rules in the same format may be
+# loaded with --api-upgrade-rules
+API_UPGRADE_RULES = [
+    {'kind': ['StatefulSet', 'DaemonSet', 'Deployment', 'ReplicaSet'], 'api': {'from': 'apps/v1beta1', 'to': 'apps/v1'}},
+    {'kind': ['StatefulSet', 'DaemonSet', 'Deployment', 'ReplicaSet'], 'api': {'from': 'apps/v1beta2', 'to': 'apps/v1'}},
+    {'kind': ['Deployment'], 'api': {'from': 'extensions/v1beta1', 'to': 'apps/v1'}},
+    {'kind': ['PodSecurityPolicy'], 'api': {'from': 'extensions/v1beta1', 'to': 'policy/v1beta1'}},
+    {'kind': ['NetworkPolicy'], 'api': {'from': 'extensions/v1beta1', 'to': 'networking.k8s.io/v1'}}
+]
+
+def compile_api_upgrades(rules):
+    '''Index upgrade rules by (kind, apiVersion). Later rules override earlier ones'''
+    table = {}
+    for rule in rules:
+        try:
+            kinds, api_from, api_to = rule['kind'], rule['api']['from'], rule['api']['to']
+        except (KeyError, TypeError):
+            raise ParseError('Invalid API upgrade rule: {}'.format(rule))
+        if isinstance(kinds, str):
+            kinds = [kinds]
+        for kind in kinds:
+            table[(kind, api_from)] = api_to
+    # Resolve chained upgrades such that each resource needs a single lookup
+    resolved = {}
+    for (kind, api), api_to in table.items():
+        seen = set([api])
+        while (kind, api_to) in table and api_to not in seen:
+            seen.add(api_to)
+            api_to = table[(kind, api_to)]
+        if api_to != api:
+            resolved[(kind, api)] = api_to
+    return resolved
+
+# Only the table of the current rule files is kept, older ones are of modified files
+@functools.lru_cache(maxsize=1)
+def _api_upgrades(rule_files):
+    import yaml
+    rules = list(API_UPGRADE_RULES)
+    for fname, mtime in rule_files:
+        logging.debug("Loading API upgrade rules '{}'".format(fname))
+        with open(fname, 'r') as fh:
+            rules += yaml.load(fh, Loader=yaml.FullLoader) or []
+    return compile_api_upgrades(rules)
+
+def api_upgrades(args):
+    '''Return the API upgrade table, (kind, apiVersion) -> apiVersion, empty unless upgrades are enabled'''
+    if not args.auto_api_upgrade:
+        return {}
+    # Rule files are loaded once, or again if modified, e.g. in server mode
+    return _api_upgrades(tuple([(fn, os.path.getmtime(fn)) for fn in args.api_upgrade_rules]))
+
+# JSON schema keywords used by compile_schema, others are pruned from cached schemas
+SCHEMA_KEYWORDS = ['type', 'properties', 'required', 'additionalProperties', 'items', 'enum', 'minimum', 'maximum',
+                   'minLength', 'maxLength', 'pattern', 'minItems', 'maxItems', 'allOf', 'anyOf', 'oneOf', '$ref',
+                   'definitions', 'nullable', 'x-kubernetes-int-or-string', 'x-kubernetes-preserve-unknown-fields']
+SCHEMA_TYPES = {'object': dict, 'array': list, 'string': str, 'integer': int, 'number': (int, float),
+                'boolean': bool, 'null': type(None)}
+
+def prune_schema(schema):
+    '''Return schema with only the keywords used for validation, e.g. without descriptions'''
+    if isinstance(schema, list):
+        return [prune_schema(s) for s in schema]
+    if not isinstance(schema, dict):
+        return schema
+    out = {}
+    for k, v in schema.items():
+        if k not in SCHEMA_KEYWORDS:
+            continue
+        if k in ['properties', 'definitions'] and isinstance(v, dict):
+            out[k] = {name: prune_schema(s) for name, s in v.items()}
+        elif k in ['enum', 'required', 'type']:
+            out[k] = v
+        else:
+            out[k] = prune_schema(v)
     return out
 
-def resource_api_upgrade(res, args):
-    upgrades = [
-        {'kind': ['StatefulSet', 'DaemonSet', 'Deployment', 'ReplicaSet'], 'api': {'from': 'apps/v1beta1', 'to': 'apps/v1'}},
-        {'kind': ['StatefulSet', 'DaemonSet', 'Deployment', 'ReplicaSet'], 'api': {'from': 'apps/v1beta2', 'to': 'apps/v1'}},
-        {'kind': ['Deployment'], 'api': {'from': 'extensions/v1beta1', 'to': 'apps/v1'}},
-        {'kind': ['PodSecurityPolicy'], 'api': {'from': 'extensions/v1beta1', 'to': 'policy/v1beta1'}},
-        {'kind': ['NetworkPolicy'], 'api': {'from': 'extensions/v1beta1', 'to': 'networking.k8s.io/v1'}}
-    ]
-    if args.auto_api_upgrade:
-        logging.debug('Doing auto API upgrade')
-        for r in res:
-            api = r['apiVersion']
-            kind = r['kind']
-            name = r['metadata']['name']
-            logging.debug('Resource {}/{} api: {}'.format(kind, name, api))
-            for upg in upgrades:
-                if kind in upg['kind'] and api==upg['api']['from']:
-                    logging.warning('Upgrade API of {}/{} from {} to {}'.format(kind, name, api, upg['api']['to']))
-                    r['apiVersion'] = upg['api']['to']
-    return res
-
-def resource_split_ns_no_ns(res, args):
-    '''Split resource into a list of those that have a specific namespace and those without namespace'''
-    out = []
-    out_ns = []
+def format_schema_path(path):
+    '''Format a path of nested (parent, key) tuples as used by compiled schemas, e.g. spec.containers[0].image'''
+    parts = []
+    while path:
+        path, key = path
+        parts.append('[{}]'.format(key) if isinstance(key, int) else '.'+str(key))
+    return ''.join(reversed(parts)).lstrip('.')
+
+def compile_schema(schema, resolve):
+    '''Compile a subset of JSON schema into a function validate(value, path, errors) appending (path, message) to errors
+
+    Paths are nested (parent, key) tuples, formatted only on errors. Properties are compiled on first use,
+    e.g. most of a large CustomResourceDefinition schema is never used. References are compiled once by
+    resolve(ref), returning a compiled schema, which allows recursive schemas.
+    '''
+    if not isinstance(schema, dict):
+        return lambda v, path, errors: None
+    if '$ref' in schema:
+        return resolve(schema['$ref'])
+    checks = []
+    types = schema.get('type')
+    if schema.get('x-kubernetes-int-or-string'):
+        types = ['integer', 'string']
+    if isinstance(types, str):
+        types = [types]
+    if types and schema.get('nullable'):
+        types = types + ['null']
+    pytypes = tuple([SCHEMA_TYPES[t] for t in types or [] if t in SCHEMA_TYPES])
+    # bool is a subclass of int
+    no_bool = 'boolean' not in (types or []) and bool not in pytypes
+
+    raw_props = schema.get('properties') or {}
+    props = {}
+    required = schema.get('required') or []
+    additional = schema.get('additionalProperties', True)
+    if schema.get('x-kubernetes-preserve-unknown-fields'):
+        additional = True
+    extra = compile_schema(additional, resolve) if isinstance(additional, dict) else None
+    extra_leaf = getattr(extra, 'leaf', None)
+    # The type check of objects is part of the object check, saving a call per object
+    object_only = pytypes == (dict,)
+    checks_object = bool(raw_props or required or additional is not True)
+    if checks_object:
+        def check_object(v, path, errors):
+            if not isinstance(v, dict):
+                if object_only:
+                    errors.append((path, 'expected object but got {}'.format(type(v).__name__)))
+                return
+            for k in required:
+                if k not in v:
+                    errors.append((path, "missing required field '{}'".format(k)))
+            for k, item in v.items():
+                prop = props.get(k)
+                if prop is None and k in raw_props:
+                    check = compile_schema(raw_props[k], resolve)
+                    prop = props[k] = (check, getattr(check, 'leaf', None))
+                if prop is not None:
+                    check, leaf = prop
+                    # Schemas only checking type, e.g. most fields, are checked inline
+                    if leaf is None or not isinstance(item, leaf[0]) or (leaf[1] and isinstance(item, bool)):
+                        check(item, (path, k), errors)
+                elif extra:
+                    if extra_leaf is None or not isinstance(item, extra_leaf[0]) or (extra_leaf[1] and isinstance(item, bool)):
+                        extra(item, (path, k), errors)
+                elif additional is False:
+                    errors.append((path, "unknown field '{}'".format(k)))
+        checks.append(check_object)
+    if 'items' in schema:
+        items = compile_schema(schema['items'], resolve)
+        def check_items(v, path, errors):
+            if isinstance(v, list):
+                for i, item in enumerate(v):
+                    items(item, (path, i), errors)
+        checks.append(check_items)
+    if 'enum' in schema:
+        enum = schema['enum']
+        def check_enum(v, path, errors):
+            if v not in enum:
+                errors.append((path, 'value {!r} not one of {}'.format(v, enum)))
+        checks.append(check_enum)
+    for key, test, msg in [('minimum', lambda v, m: v < m, 'less than minimum'),
+                           ('maximum', lambda v, m: v > m, 'greater than maximum')]:
+        if key in schema:
+            def check_number(v, path, errors, m=schema[key], test=test, msg=msg):
+                if isinstance(v, (int, float)) and not isinstance(v, bool) and test(v, m):
+                    errors.append((path, 'value {} {} {}'.format(v, msg, m)))
+            checks.append(check_number)
+    for key, cls, test in [('minLength', str, lambda n, m: n < m), ('maxLength', str, lambda n, m: n > m),
+                           ('minItems', list, lambda n, m: n < m), ('maxItems', list, lambda n, m: n > m)]:
+        if key in schema:
+            def check_length(v, path, errors, m=schema[key], cls=cls, test=test, key=key):
+                if isinstance(v, cls) and test(len(v), m):
+                    errors.append((path, 'length {} violates {} {}'.format(len(v), key, m)))
+            checks.append(check_length)
+    if 'pattern' in schema:
+        import re
+        pattern = re.compile(schema['pattern'])
+        def check_pattern(v, path, errors):
+            if isinstance(v, str) and not pattern.search(v):
+                errors.append((path, 'value {!r} does not match {}'.format(v, pattern.pattern)))
+        checks.append(check_pattern)
+    for s in schema.get('allOf') or []:
+        checks.append(compile_schema(s, resolve))
+    for key in ['anyOf', 'oneOf']:
+        # oneOf is checked like anyOf, i.e. at least one schema must match
+        if schema.get(key):
+            alternatives = [compile_schema(s, resolve) for s in schema[key]]
+            def check_any(v, path, errors, alternatives=alternatives, key=key):
+                for alt in alternatives:
+                    errs = []
+                    alt(v, path, errs)
+                    if not errs:
+                        return
+                errors.append((path, 'value does not match any schema of {}'.format(key)))
+            checks.append(check_any)
+
+    # The object check, if any, is the first check
+    if len(checks) == 1 and (not pytypes or (object_only and checks_object)):
+        return checks[0]
+    def validate(v, path, errors):
+        if pytypes and (not isinstance(v, pytypes) or (no_bool and isinstance(v, bool))):
+            errors.append((path, 'expected {} but got {}'.format(' or '.join(types), type(v).__name__)))
+            return
+        for check in checks:
+            check(v, path, errors)
+    if pytypes and not checks:
+        validate.leaf = (pytypes, no_bool)
+    return validate
+
+class SchemaIndex:
+    '''Compiled schemas of a schema directory, indexed by (apiVersion, kind) and compiled on first use
+
+    Schema files are named as in kubernetes-json-schema, e.g. 'deployment-apps-v1.json', or as in
+    the CRDs-catalog, e.g. 'monitoring.coreos.com/prometheus_v1.json'. With a cache dir, schemas
+    are kept pruned to the keywords used for validation.
+    '''
+    def __init__(self, path, cache_dir=None):
+        self.path = path
+        self.cache = os.path.join(cache_dir, 'schemas') if cache_dir else None
+        self.validators = {}    # (apiVersion, kind) -> compiled schema, None if no schema
+        self.docs = {}          # filename -> pruned schema
+        self.refs = {}          # (filename, pointer) -> compiled schema
+        self._lock = threading.Lock()
+
+    def load(self, fname):
+        '''Return pruned schema of file, using the cache dir if given'''
+        import hashlib
+        import json
+        if fname in self.docs:
+            return self.docs[fname]
+        cached = None
+        if self.cache:
+            st = os.stat(fname)
+            ident = '\0'.join([os.path.realpath(fname), str(st.st_mtime_ns), str(st.st_size)])
+            cached = os.path.join(self.cache, hashlib.sha256(ident.encode('UTF-8')).hexdigest()+'.json')
+            try:
+                with open(cached, 'r') as fh:
+                    self.docs[fname] = json.load(fh)
+                return self.docs[fname]
+            except FileNotFoundError:
+                pass
+            except ValueError:
+                logging.warning("Ignoring corrupt cached schema of '{}'".format(fname))
+        with open(fname, 'r') as fh:
+            doc = prune_schema(json.load(fh))
+        if cached:
+            os.makedirs(self.cache, exist_ok=True)
+            with atomic_write(cached) as fh:
+                json.dump(doc, fh, separators=(',', ':'))
+        self.docs[fname] = doc
+        return doc
+
+    def resolver(self, fname):
+        '''Return function compiling references relative to schema file fname'''
+        def resolve(ref):
+            target, _, pointer = ref.partition('#')
+            target = os.path.join(os.path.dirname(fname), target) if target else fname
+            key = (target, pointer)
+            if key not in self.refs:
+                # Placeholder for recursive references, replaced once compiled
+                cell = []
+                self.refs[key] = lambda v, path, errors: cell[0](v, path, errors)
+                node = self.load(target)
+                for part in [p for p in pointer.split('/') if p]:
+                    node = node[part.replace('~1', '/').replace('~0', '~')]
+                cell.append(compile_schema(node, self.resolver(target)))
+                self.refs[key] = cell[0]
+            return self.refs[key]
+        return resolve
+
+    @staticmethod
+    def filenames(api, kind):
+        group, _, version = api.rpartition('/')
+        kind = kind.lower()
+        if not group:
+            return ['{}-{}.json'.format(kind, version)]
+        return ['{}-{}-{}.json'.format(kind, group.split('.')[0], version),
+                os.path.join(group, '{}_{}.json'.format(kind, version))]
+
+    def lookup(self, api, kind):
+        '''Return compiled schema of (apiVersion, kind), None if there is no schema'''
+        key = (api, kind)
+        with self._lock:
+            if key not in self.validators:
+                self.validators[key] = None
+                for fn in self.filenames(api, kind):
+                    fname = os.path.join(self.path, fn)
+                    if os.path.exists(fname):
+                        logging.debug("Compiling schema '{}'".format(fname))
+                        self.validators[key] = self.resolver(fname)('')
+                        break
+            return self.validators[key]
+
+def schema_path(schema_dir, kube_version):
+    '''Return the directory of schemas for a Kubernetes version, as laid out by kubernetes-json-schema'''
+    if kube_version:
+        v = kube_version if kube_version.startswith('v') else 'v'+kube_version
+        versions = [v, v+'.0'] if v.count('.') == 1 else [v]
+    else:
+        versions = ['master']
+    for v in versions:
+        for d in [v+'-standalone-strict', v+'-standalone', v]:
+            if os.path.isdir(os.path.join(schema_dir, d)):
+                return os.path.join(schema_dir, d)
+    if kube_version:
+        raise ParseError("No schemas for Kubernetes {} in '{}'".format(kube_version, schema_dir))
+    return schema_dir
+
+@functools.lru_cache(maxsize=None)
+def _schema_index(path, cache_dir):
+    return SchemaIndex(path, cache_dir)
+
+def schema_index(args):
+    '''Return the schema index selected by --schema-dir and --kube-version, shared by runs, e.g. in server mode'''
+    return _schema_index(schema_path(args.schema_dir, args.kube_version), args.cache_dir or None)
+
+class ValidationError(Exception):
+    pass
+
+class SchemaValidator:
+    '''Validates resources of a run against a schema index and the schemas of CustomResourceDefinitions rendered'''
+    def __init__(self, index):
+        self.index = index
+        self.crds = {}      # (apiVersion, kind) -> compiled schema
+        self.counts = collections.Counter()
+
+    def register_crd(self, crd):
+        spec = crd.get('spec') or {}
+        group = spec.get('group')
+        kind = (spec.get('names') or {}).get('kind')
+        versions = spec.get('versions') or [{'name': spec.get('version')}]
+        for v in versions:
+            # apiextensions.k8s.io/v1beta1 CRDs may have one schema for all versions
+            schema = (v.get('schema') or spec.get('validation') or {}).get('openAPIV3Schema')
+            if group and kind and v.get('name') and schema:
+                logging.debug('Registering schema of {}/{} {}'.format(group, v['name'], kind))
+                # References are not allowed in CustomResourceDefinition schemas
+                self.crds[('{}/{}'.format(group, v['name']), kind)] = compile_schema(schema, lambda ref: lambda v, path, errors: None)
+
+    def validate(self, rid, resources):
+        '''Validate resources of a release, CustomResourceDefinitions are registered first'''
+        resources = list(resources)
+        for r in resources:
+            if r.get('kind') == 'CustomResourceDefinition':
+                self.register_crd(resource_data(r))
+        for r in resources:
+            api, kind = str(r.get('apiVersion')), str(r.get('kind'))
+            check = self.crds.get((api, kind)) or self.index.lookup(api, kind)
+            if not check:
+                logging.debug('No schema for {} {}'.format(api, kind))
+                self.counts['no_schema'] += 1
+                continue
+            errors = []
+            check(resource_data(r), None, errors)
+            self.counts['invalid' if errors else 'valid'] += 1
+            name = (r.get('metadata') or {}).get('name')
+            for path, msg in errors:
+                path = format_schema_path(path)
+                logging.error('{}: {} {}: {}{}'.format(rid, kind, name, path+': ' if path else '', msg))
+                self.counts['errors'] += 1
+
+    def log_summary(self):
+        logging.info('Validated {} resources: {} invalid with {} errors, {} without schema'.format(
+            self.counts['valid']+self.counts['invalid'], self.counts['invalid'], self.counts['errors'], self.counts['no_schema']))
+        for k in ['valid', 'invalid', 'no_schema']:
+            METRICS.count('validated_resources', self.counts[k], result=k)
+
+# Kinds in the order Helm installs them, see InstallOrder in helm/pkg/releaseutil/kind_sorter.go
+INSTALL_ORDER = [
+    'PriorityClass', 'Namespace', 'NetworkPolicy', 'ResourceQuota', 'LimitRange', 'PodSecurityPolicy',
+    'PodDisruptionBudget', 'ServiceAccount', 'Secret', 'SecretList', 'ConfigMap', 'StorageClass',
+    'PersistentVolume', 'PersistentVolumeClaim', 'CustomResourceDefinition', 'ClusterRole', 'ClusterRoleList',
+    'ClusterRoleBinding', 'ClusterRoleBindingList', 'Role', 'RoleList', 'RoleBinding', 'RoleBindingList',
+    'Service', 'DaemonSet', 'Pod', 'ReplicationController', 'ReplicaSet', 'Deployment', 'HorizontalPodAutoscaler',
+    'StatefulSet', 'Job', 'CronJob', 'IngressClass', 'Ingress', 'APIService'
+]
+INSTALL_ORDER_INDEX = {kind: i for i, kind in enumerate(INSTALL_ORDER)}
+
+def resource_sort_key(r):
+    '''Sort by install order of kind, unknown kinds last by name, then by namespace and name'''
+    kind = r.get('kind') or ''
+    meta = r.get('metadata') or {}
+    return (INSTALL_ORDER_INDEX.get(kind, len(INSTALL_ORDER)), kind, meta.get('namespace') or '', str(meta.get('name', '')))
+
+def resource_classify(res, args):
+    '''Filter hooks, upgrade API versions and sort resources into output buckets in a single pass.
+    Returns lists of resources without namespace, with namespace, secrets and secrets with namespace'''
+    debug = debug_enabled()
+    hook_filter = args.hook_filter
+    upgrades = api_upgrades(args)
+    split_ns = args.separate_with_namespace
+    split_secrets = args.separate_secrets
+    if hook_filter:
+        logging.debug("Hook filter using '{}'".format(hook_filter))
+    buckets = ([], [], [], [])
     for r in res:
-        kind = r['kind']
-        name = r['metadata']['name']
-        logging.debug('Resource {}/{}'.format(kind, name))
-        if 'namespace' in r['metadata']:
-            out_ns.append(r)
-        else:
-            out.append(r)
-    return out, out_ns
+        kind = r.get('kind')
+        meta = r.get('metadata') or {}
+        if hook_filter:
+            anno = meta.get('annotations')
+            if anno and anno.get('helm.sh/hook') in hook_filter:
+                logging.info('Filtering resource {}/{}'.format(kind, meta.get('name')))
+                continue
+        if upgrades:
+            api = r.get('apiVersion')
+            api_to = upgrades.get((kind, api))
+            if api_to:
+                logging.warning('Upgrade API of {}/{} from {} to {}'.format(kind, meta.get('name'), api, api_to))
+                # Raw resources are only parsed when rewritten
+                r = resource_data(r)
+                r['apiVersion'] = api_to
+        bucket = 0
+        if split_ns and 'namespace' in meta:
+            bucket = 1
+        if split_secrets and kind == 'Secret':
+            bucket += 2
+        if debug:
+            logging.debug('Resource {}/{}/{} into bucket {}'.format(r.get('apiVersion'), kind, meta.get('name'), bucket))
+        buckets[bucket].append(r)
+    if not args.no_sort:
+        for b in buckets:
+            b.sort(key=resource_sort_key)
+    return buckets
 
-def resource_separate(res, kinds):
-    '''Split out resource of specific kinds'''
-    out = []
-    out_sep = []
+def resource_trace(header, res):
+    '''Like resource_list, but for resources flowing through an iterator'''
+    if not debug_enabled():
+        return res
+    return _resource_trace(header, res)
+
+def _resource_trace(header, res):
+    logging.debug('{}:'.format(header))
     for r in res:
-        kind = r['kind']
-        name = r['metadata']['name']
-        logging.debug('Resource {}/{}'.format(kind, name))
-        if kind in kinds:
-            out_sep.append(r)
-        else:
-            out.append(r)
-    return out, out_sep
+        logging.debug('Resource {}/{}/{}'.format(r.get('apiVersion'), r.get('kind'), r.get('metadata', {}).get('name')))
+        yield r
 
 def resource_list(header, res):
+    if not debug_enabled():
+        return
     logging.debug('{} ({} resources):'.format(header, len(res)))
     for r in res:
         if not set(['apiVersion', 'kind', 'metadata']).issubset(r.keys()):
@@ -380,142 +1972,973 @@ def resource_list(header, res):
         name = r['metadata']['name']
         logging.debug('Resource {}/{}/{}'.format(api, kind, name))
 
-def run_helm(specs, args):
-    if args.skip_helm:
-        return []
+def helm_template(cmd, args, app, cache_fh=None):
+    '''Run 'helm template' and classify resources while Helm emits them'''
+    import subprocess
+    logging.debug('Helm command: {}'.format(cmd))
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    try:
+        stream = io.TextIOWrapper(proc.stdout, encoding='UTF-8', errors='ignore')
+        if cache_fh:
+            stream = TeeReader(stream, cache_fh)
+        buckets = resource_pipeline(stream, args, app, 'template')
+    except BaseException:
+        proc.kill()
+        raise
+    finally:
+        proc.stdout.close()
+        rc = proc.wait()
+    if rc:
+        raise subprocess.CalledProcessError(rc, cmd)
+    return buckets
+
+def env_expand(v):
+    '''Expand environment variables in all strings of a value'''
+    if isinstance(v, str):
+        return string.Template(v).safe_substitute(os.environ)
+    if isinstance(v, dict):
+        return {k: env_expand(x) for k,x in v.items()}
+    if isinstance(v, list):
+        return [env_expand(x) for x in v]
+    return v
+
+def helm_strval(v):
+    '''Type a string value like 'helm --set' does, including '{a,b}' lists'''
+    if v[:1] == '{' and v[-1:] == '}':
+        return [helm_strval(x) for x in v[1:-1].split(',')] if v[1:-1] else []
+    lv = v.lower()
+    if lv == 'true':
+        return True
+    if lv == 'false':
+        return False
+    if lv == 'null':
+        return None
+    if v == '0':
+        return 0
+    digits = v[1:] if v[:1] in ['+', '-'] else v
+    if v[:1] != '0' and digits.isdigit() and digits.isascii() and -2**63 <= int(v) < 2**63:
+        return int(v)
+    return v
+
+def split_set_key(key):
+    '''Split a 'helm --set' style key into a path, e.g. 'a.b\\.c[0]' into ['a', 'b.c', 0]'''
+    path = []
+    name = ''
+    i = 0
+    while i < len(key):
+        c = key[i]
+        if c == '\\' and i+1 < len(key):
+            name += key[i+1]
+            i += 1
+        elif c == '.':
+            if name:
+                path.append(name)
+            name = ''
+        elif c == '[':
+            end = key.find(']', i)
+            if end < 0 or not key[i+1:end].isdigit():
+                raise ParseError("Invalid list index in value key '{}'".format(key))
+            if name:
+                path.append(name)
+            name = ''
+            path.append(int(key[i+1:end]))
+            i = end
+        else:
+            name += c
+        i += 1
+    if name:
+        path.append(name)
+    if not path or isinstance(path[0], int):
+        raise ParseError("Invalid value key '{}'".format(key))
+    return path
+
+def merge_values(dst, src):
+    '''Merge nested values of src into dst'''
+    for k,v in src.items():
+        if isinstance(v, dict) and isinstance(dst.get(k), dict):
+            merge_values(dst[k], v)
+        else:
+            dst[k] = v
+
+def set_value(values, path, value):
+    '''Set value at a path from split_set_key in nested values'''
+    node = values
+    for k, nxt in zip(path, path[1:]):
+        empty = [] if isinstance(nxt, int) else {}
+        if isinstance(k, int):
+            node.extend([None]*(k+1-len(node)))
+            if type(node[k]) is not type(empty):
+                node[k] = empty
+        elif type(node.get(k)) is not type(empty):
+            node[k] = empty
+        node = node[k]
+    k = path[-1]
+    if isinstance(k, int):
+        node.extend([None]*(k+1-len(node)))
+    elif isinstance(value, dict) and isinstance(node.get(k), dict):
+        merge_values(node[k], value)
+        return
+    node[k] = value
+
+def helm_set_values(values, set_values):
+    '''Merge Helmsman 'set' values into nested values. Keys and string values follow 'helm --set' syntax and typing'''
+    for k,v in set_values.items():
+        if type(v) is str:
+            v = helm_strval(v)
+        set_value(values, split_set_key(str(k)), v)
+    return values
+
+def warn_dotted_values(app):
+    '''Warn about dotted top-level keys of KRM valuesInline or Flux values, which are not split into nested values'''
+    for k in app.get('values') or {}:
+        if '.' in str(k):
+            logging.warning("Release {}: inline value key '{}' is not split on dots, use nested values".format(release_id(app), k))
+
+def spec_inline_values(app):
+    '''Inline values of a release spec as nested values, without environment expansion'''
+    import copy
+    warn_dotted_values(app)
+    return helm_set_values(copy.deepcopy(app.get('values') or {}), app.get('set') or {})
 
-    tmpdir = tempfile.mkdtemp()
-    out = subprocess.check_output('mkdir -p {}'.format(tmpdir), shell=True)
-    logging.debug("Run helm: Using tmp dir: '{}'".format(tmpdir))
+def helm_values(app, state):
+    '''Return environment expanded inline values merged into one dict, and values files of a release'''
+    # KRM valuesInline and Flux values are used as they are
+    warn_dotted_values(app)
+    inline = env_expand(app.get('values') or {})
+    helm_set_values(inline, env_expand(app.get('set') or {}))
+    values = []
+    for vf in app.get('valuesfiles', []):
+        values.append((vf, state.expand_values('{}/{}'.format(app['dirname'], vf))))
+    return inline, values
 
-    if args.local_chart_path:
-        chartdir = args.local_chart_path
+def helm_cmd(args):
+    '''Helm command as argument list, the helm binary option may include arguments'''
+    import shlex
+    return shlex.split(args.helm_bin)
+
+def helm_render(app, args, state):
+    '''Fetch and template a single release, returning its resources sorted into output buckets'''
+    import tempfile
+    import yaml
+    # Each release gets its own scratch directory such that releases can be rendered concurrently
+    workdir = tempfile.mkdtemp(dir=state.rundir)
+    logging.debug("Render {}: Using work dir: '{}'".format(app['rel_name'], workdir))
+    render_cache = state.render_cache
+    chart, digest = state.fetch_chart(app, args)
+
+    with METRICS.phase('values', app['rel_name']):
+        inline, values = helm_values(app, state)
+
+    cached = None
+    if render_cache:
+        key = render_cache.key(app, args, digest, values, inline)
+        cached = render_cache.lookup(key)
+    if cached:
+        logging.debug('Render cache hit for {}: {}'.format(app['rel_name'], key))
+        with cached:
+            return resource_pipeline(cached, args, app, 'cache-read')
+
+    chartpath = state.extractor.extract(app, chart, digest)
+    cmd = helm_cmd(args) + ['template', '--include-crds', app['rel_name'], '--namespace', app['namespace']]
+    if args.kube_version:
+        cmd += ['--kube-version', args.kube_version]
+    for apiver in args.api_versions:
+        cmd += ['--api-versions', apiver]
+    with METRICS.phase('values-file', app['rel_name']):
+        for vf, dst in values:
+            cmd += ['--values', state.values_file('{}/{}'.format(app['dirname'], vf))]
+        # Inline values are passed last, such that they take precedence like with '--set'
+        if inline:
+            fname = os.path.join(workdir, 'inline-values.yaml')
+            with open(fname, 'w') as fh:
+                yaml.dump(inline, fh, Dumper=yaml_dumper(), default_flow_style=False)
+            cmd += ['--values', fname]
+    cmd += [chartpath]
+    with render_cache.writer(key) if render_cache else contextlib.nullcontext() as cache_fh:
+        return helm_template(cmd, args, app, cache_fh)
+
+def resource_pipeline(stream, args, app, source):
+    '''Parse and classify resources from stream into output buckets, accounting time and sizes in METRICS'''
+    reader = MeteredReader(stream)
+    parse_time = [0.0, 0.0]
+    wall, cpu = time.perf_counter(), time.thread_time()
+    res = metered(raw_resources(reader) if args.raw_passthrough else yaml2dict(reader), parse_time)
+    res = resource_trace('Resources from Helm', res)
+    buckets = resource_classify(res, args)
+    wall, cpu = time.perf_counter()-wall, time.thread_time()-cpu
+
+    release = app['rel_name']
+    # Time spent reading includes waiting for Helm
+    METRICS.add(source, release, reader.wall, reader.cpu)
+    METRICS.add('parse', release, parse_time[0]-reader.wall, parse_time[1]-reader.cpu)
+    METRICS.add('process', release, wall-parse_time[0], cpu-parse_time[1])
+    METRICS.count('input_bytes', reader.nbytes, release=release, source=source)
+    kinds = collections.Counter([r.get('kind') for r in itertools.chain(*buckets)])
+    for kind, n in kinds.items():
+        METRICS.count('resources', n, kind=kind)
+    if args.raw_passthrough:
+        raw = sum([isinstance(r, RawResource) for r in itertools.chain(*buckets)])
+        METRICS.count('raw_resources', raw, state='passthrough')
+        METRICS.count('raw_resources', sum([len(b) for b in buckets])-raw, state='parsed')
+    return buckets
+
+def release_outputs(app, args):
+    '''Return output filenames of a release, None for outputs not in use'''
+    if args.add_namespace_to_path:
+        base = args.render_path + '/' + app['namespace'] + '-' + app['rel_name']
+        base_ns = args.render_path + '/' + args.namespace_filename_prefix + app['namespace'] + '-' + app['rel_name']
     else:
-        chartdir = tmpdir
-    logging.debug("Run helm: Using chart dir: '{}'".format(tmpdir))
+        base = args.render_path + '/' + app['rel_name']
+        base_ns = args.render_path + '/' + args.namespace_filename_prefix + app['rel_name']
+    outputs = {'res': base + '.yaml',
+               'res_ns': None,
+               'secrets': None,
+               'secrets_ns': None,
+               'namespace': base_ns + '-ns.yaml'}
+    if args.separate_secrets:
+        outputs['secrets'] = base + '-secrets.yaml'
+    if args.separate_with_namespace:
+        outputs['res_ns'] = base + '-w-ns.yaml'
+        if args.separate_secrets:
+            outputs['secrets_ns'] = base + '-secrets-w-ns.yaml'
+    return outputs
 
-    apps = []
+def plan_releases(specs, args):
+    '''Build the work plan of a run, i.e. releases with their output files. Fails if releases would write the same files'''
+    plan = []
+    owners = {}
+    collisions = []
     for app in specs:
-        helm_fetch_chart(app, args, chartdir, tmpdir)
-        cmd = '{} template --include-crds {} --namespace {}'.format(args.helm_bin, app['rel_name'], app['namespace'])
-        if args.kube_version:
-            cmd += ' --kube-version {}'.format(args.kube_version)
-        for apiver in args.api_versions:
-            cmd += ' --api-versions {}'.format(apiver)
-        for k,v in app.get('set', dict()).items():
-            if type(v) is str:
-                cmd += " --set {}='{}'".format(k,string.Template(v).safe_substitute(os.environ))
+        outputs = release_outputs(app, args)
+        plan.append((app, outputs))
+        if args.output != 'file':
+            continue
+        for kind, fname in outputs.items():
+            if not fname or (kind == 'namespace' and not args.add_namespace):
+                continue
+            if fname in owners:
+                other = owners[fname]
+                collisions.append("'{}' from {}/{} and {}/{}".format(fname, other['namespace'], other['rel_name'], app['namespace'], app['rel_name']))
+            owners[fname] = app
+    if collisions:
+        raise ParseError('Releases with colliding output files (consider --add-namespace-to-path): {}'.format(', '.join(collisions)))
+
+    charts = set([(app.get('repository'), app['chart'], str(app['version'])) for app in specs])
+    values = set([os.path.realpath('{}/{}'.format(app['dirname'], vf)) for app in specs for vf in app.get('valuesfiles', [])])
+    logging.info('Rendering {} releases using {} distinct charts and {} distinct values files'.format(len(specs), len(charts), len(values)))
+    return plan
+
+MANIFEST_NAME = '.helm2yaml.manifest'
+MANIFEST_VERSION = 1
+
+def release_id(app):
+    return '{}/{}'.format(app['namespace'], app['rel_name'])
+
+def release_input_hash(app, args, state):
+    '''Hash of everything affecting the rendered output of a release'''
+    import hashlib
+    import json
+    flags = ['helm_bin', 'kube_version', 'api_versions', 'hook_filter', 'auto_api_upgrade', 'no_sort',
+             'separate_secrets', 'separate_with_namespace', 'add_namespace', 'add_namespace_to_path',
+             'namespace_filename_prefix', 'local_chart_path', 'layout', 'raw_passthrough']
+    inline, values = helm_values(app, state)
+    chart, digest = state.fetch_chart(app, args)
+    inputs = {'manifest': MANIFEST_VERSION,
+              'spec': app,
+              'digest': digest,
+              'inline': inline,
+              'values': values,
+              'api_upgrade_rules': [file_digest(fn) for fn in getattr(args, 'api_upgrade_rules', [])],
+              'flags': {f: getattr(args, f, None) for f in flags}}
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode('UTF-8')).hexdigest()
+
+def manifest_owned(entry, sources):
+    '''Whether a manifest entry is of a release defined by the spec files or directories sources'''
+    source = entry.get('source')
+    if source is None:
+        return True     # Recorded before sources were, assume the same spec
+    return any([source == s or source.startswith(os.path.join(s, '')) for s in sources])
+
+def load_manifest(args):
+    import json
+    fname = os.path.join(args.render_path, MANIFEST_NAME)
+    try:
+        with open(fname, 'r') as fh:
+            manifest = json.load(fh)
+    except FileNotFoundError:
+        return {}
+    if manifest.get('version') != MANIFEST_VERSION:
+        logging.warning("Ignoring manifest '{}' with unknown version".format(fname))
+        return {}
+    releases = manifest.get('releases', {})
+    for rid, release in releases.items():
+        outputs = []
+        for fn in release.get('outputs', []):
+            if os.path.isabs(fn) or '..' in fn.replace(os.sep, '/').split('/'):
+                logging.warning("Ignoring output '{}' of release {} in manifest '{}', not within render path".format(fn, rid, fname))
             else:
-                cmd += ' --set {}={}'.format(k,v)
-        for vf in app.get('valuesfiles', []):
-            with open('{}/{}'.format(tmpdir, vf), 'w') as vfn_dst:
-                with open('{}/{}'.format(app['dirname'], vf), 'r') as vfn_src:
-                    src = vfn_src.read()
-                    dst = string.Template(src).safe_substitute(os.environ)
-                    logging.debug('Env expanded values in file {}:\n{}'.format(vf, dst))
-                    vfn_dst.write(dst)
-            cmd += ' --values {}/{}'.format(tmpdir, vf)
-        cmd += ' {}/{}'.format(tmpdir, app['chart'])
-        logging.debug('Helm command: {}'.format(cmd))
-        out = subprocess.check_output(cmd, shell=True)
-        out = out.decode('UTF-8','ignore')
-        logging.debug('Output from Helm: {}'.format(out))
-        res = yaml2dict(out)
-        resource_list('Resources from Helm', res)
-        res = resource_filter(res, args)
-        res = resource_api_upgrade(res, args)
-        resource_list('Upgraded resources', res)
-
-        if args.add_namespace_to_path:
-            base = args.render_path + '/' + app['namespace'] + '-' + app['rel_name']
-            base_ns = args.render_path + '/' + args.namespace_filename_prefix + app['namespace'] + '-' + app['rel_name']
-        else:
-            base = args.render_path + '/' + app['rel_name']
-            base_ns = args.render_path + '/' + args.namespace_filename_prefix + app['rel_name']
-        render_to = base + '.yaml'
-        render_namespace_to = base_ns + '-ns.yaml'
-        render_w_ns_to = None
-        render_secrets_to = None
-        render_secrets_w_ns_to = None
-        if args.separate_secrets:
-            render_secrets_to = base + '-secrets.yaml'
-        if args.separate_with_namespace:
-            render_w_ns_to = base + '-w-ns.yaml'
-            if args.separate_secrets:
-                render_secrets_w_ns_to = base + '-secrets-w-ns.yaml'
-
-        if render_w_ns_to:
-            res, res_ns = resource_split_ns_no_ns(res, args)
-        else:
-            res_ns = []
-        if render_secrets_to:
-            res, secrets = resource_separate(res, ['Secret'])
+                outputs.append(fn)
+        release['outputs'] = outputs
+    return releases
+
+def save_manifest(args, releases):
+    import json
+    fname = os.path.join(args.render_path, MANIFEST_NAME)
+    with atomic_write(fname) as fh:
+        json.dump({'version': MANIFEST_VERSION, 'releases': releases}, fh, indent=2, sort_keys=True)
+        fh.write('\n')
+
+INDEX_NAME = '.helm2yaml.index'
+
+def resource_key(r):
+    '''Identity of a resource within a release'''
+    meta = r.get('metadata') or {}
+    return '|'.join([str(r.get('apiVersion', '')), str(r.get('kind', '')), str(meta.get('namespace') or ''), str(meta.get('name', ''))])
+
+def release_index(files, render_path, old=None):
+    '''Return {key: [hash, file]} of the resources of a release, hashing a canonical form and with files relative to render path
+
+    Raw resources add a hash of their text. When it matches the old index of the release, the canonical hash is
+    taken from there instead of parsing the resource, such that hashes do not depend on --raw-passthrough'''
+    import hashlib
+    import json
+    old = old or {}
+    index = {}
+    for fname, res in files:
+        fn = os.path.relpath(fname, render_path)
+        for r in res:
+            key = resource_key(r)
+            if isinstance(r, RawResource):
+                raw = hashlib.sha256(r.text.encode('UTF-8')).hexdigest()
+                prev = old.get(key)
+                if prev and len(prev) > 2 and prev[2] == raw:
+                    index[key] = [prev[0], fn, raw]
+                    continue
+            data = json.dumps(resource_data(r), sort_keys=True, separators=(',', ':'), default=str).encode('UTF-8')
+            index[key] = [hashlib.sha256(data).hexdigest(), fn]
+            if isinstance(r, RawResource):
+                index[key].append(raw)
+    return index
+
+def load_index(args):
+    import json
+    try:
+        with open(os.path.join(args.render_path, INDEX_NAME), 'r') as fh:
+            index = json.load(fh)
+    except FileNotFoundError:
+        return None
+    if index.get('version') != MANIFEST_VERSION:
+        return None
+    return index.get('releases', {})
+
+class IndexSpool:
+    '''Index entries of releases, written to a spool file as releases complete such that they are not
+    kept in memory. save() assembles the index of the render path from the spool file'''
+    def __init__(self, fname):
+        self.fname = fname
+        self.fh = open(fname, 'w', encoding='UTF-8')
+        self.count = 0
+
+    def add(self, rid, entries):
+        import json
+        if self.count:
+            self.fh.write(',')
+        self.fh.write(json.dumps(rid) + ':' + json.dumps(entries, sort_keys=True, separators=(',', ':')))
+        self.count += 1
+
+    def close(self):
+        self.fh.close()
+
+    def save(self, args):
+        self.close()
+        import shutil
+        fname = os.path.join(args.render_path, INDEX_NAME)
+        with atomic_write(fname) as fh, open(self.fname, 'r', encoding='UTF-8') as spool:
+            fh.write('{"releases":{')
+            shutil.copyfileobj(spool, fh)
+            fh.write('}},"version":{}}}'.format(MANIFEST_VERSION))
+
+MISSING = '<none>'
+REDACTED = '<redacted>'
+
+def diff_fields(old, new, path=''):
+    '''Yield (path, old, new) of differing values, recursing into dicts and lists of equal length'''
+    if isinstance(old, dict) and isinstance(new, dict):
+        for k in sorted(set(old) | set(new), key=str):
+            yield from diff_fields(old.get(k, MISSING), new.get(k, MISSING), '{}.{}'.format(path, k) if path else str(k))
+    elif isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        for i, (a, b) in enumerate(zip(old, new)):
+            yield from diff_fields(a, b, '{}[{}]'.format(path, i))
+    elif old != new:
+        yield path, old, new
+
+class DiffReport:
+    '''Prints objects added, changed and removed compared with the index of the previous render'''
+    def __init__(self, args):
+        self.args = args
+        self.counts = collections.Counter()
+        self._old_files = {}    # file -> {key: resource} of the current release, only files with changed objects are read
+
+    def old_resource(self, fn, key):
+        if fn not in self._old_files:
+            objs = {}
+            with contextlib.suppress(FileNotFoundError):
+                with open(os.path.join(self.args.render_path, fn), 'r') as fh:
+                    for r in yaml2dict(fh, expand_env=False):
+                        objs[resource_key(r)] = r
+            self._old_files[fn] = objs
+        return self._old_files[fn].get(key)
+
+    @staticmethod
+    def describe(key):
+        api, kind, namespace, name = key.split('|', 3)
+        return '{} {} {}{}'.format(api, kind, namespace+'/' if namespace else '', name)
+
+    def release(self, rid, old, new, files=()):
+        '''Print differences of a release, files are the new (filename, resources) needed for field diffs'''
+        import json
+        # Files of a release are not shared with other releases
+        self._old_files = {}
+        added = [k for k in new if k not in old]
+        changed = [k for k in new if k in old and old[k][0] != new[k][0]]
+        removed = [k for k in old if k not in new]
+        self.counts.update({'added': len(added), 'changed': len(changed), 'removed': len(removed),
+                            'unchanged': len(new)-len(added)-len(changed)})
+        if not (added or changed or removed):
+            return
+        print('--- {}'.format(rid))
+        for k in added:
+            print('+ {}'.format(self.describe(k)))
+        resources = {}
+        if changed and self.args.diff_fields:
+            changed_keys = set(changed)
+            resources = {resource_key(r): r for fname, res in files for r in res if resource_key(r) in changed_keys}
+        for k in changed:
+            print('~ {}'.format(self.describe(k)))
+            if not self.args.diff_fields:
+                continue
+            prev = self.old_resource(old[k][1], k)
+            if prev is None:
+                print("    previous object not found in '{}'".format(old[k][1]))
+                continue
+            secret = k.split('|')[1] == 'Secret'
+            for path, a, b in diff_fields(prev, resource_data(resources[k])):
+                if secret and path.split('.')[0].split('[')[0] in ['data', 'stringData']:
+                    a, b = [v if v is MISSING else REDACTED for v in [a, b]]
+                print('    {}: {} -> {}'.format(path, *[v if v is MISSING or v is REDACTED else json.dumps(v, default=str)
+                                                     for v in [a, b]]))
+        for k in removed:
+            print('- {}'.format(self.describe(k)))
+
+    def log_summary(self):
+        logging.info('Diff: {} added, {} changed, {} removed, {} unchanged objects'.format(
+            self.counts['added'], self.counts['changed'], self.counts['removed'], self.counts['unchanged']))
+
+def safe_filename(name):
+    return ''.join([c if c.isalnum() or c in '._-' else '_' for c in name])
+
+def output_shards(fname, res, layout):
+    '''Split the resources of an output file into files according to --layout, as (filename, resources)'''
+    if layout == 'release':
+        return [(fname, res)]
+    base = fname[:-len('.yaml')] if fname.endswith('.yaml') else fname
+    shards = {}
+    for r in res:
+        kind = str(r.get('kind') or 'unknown').lower()
+        if layout == 'kind':
+            name = kind
         else:
-            secrets = []
-        if render_secrets_w_ns_to and render_w_ns_to:
-            res_ns, secrets_ns = resource_separate(res_ns, ['Secret'])
+            meta = r.get('metadata') or {}
+            name = '-'.join([kind] + [str(meta[k]) for k in ['namespace', 'name'] if meta.get(k)])
+        shards.setdefault(os.path.join(base, safe_filename(name)+'.yaml'), []).append(r)
+    return list(shards.items())
+
+class HashingWriter:
+    '''File-like wrapper hashing the text written'''
+    def __init__(self, fh):
+        import hashlib
+        self.fh = fh
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        b = data.encode('UTF-8')
+        self.hash.update(b)
+        self.size += len(b)
+        return self.fh.write(data)
+
+class OutputWriter:
+    '''Writes output files through a temporary file renamed into place, files with unchanged content are left untouched'''
+    def __init__(self, path):
+        self.path = path
+        self.written = 0
+        self.unchanged = 0
+        self.removed = 0
+
+    def is_unchanged(self, fname, out):
+        try:
+            if os.path.getsize(fname) != out.size:
+                return False
+        except FileNotFoundError:
+            return False
+        return file_digest(fname) == out.hash.hexdigest()
+
+    @contextlib.contextmanager
+    def open(self, fname):
+        import tempfile
+        dirname = os.path.dirname(fname) or '.'
+        os.makedirs(dirname, exist_ok=True)
+        fd, tmpname = tempfile.mkstemp(dir=dirname, prefix='.'+os.path.basename(fname)+'.')
+        try:
+            with open(fd, 'w', encoding='UTF-8', buffering=OUTPUT_BUFFER_SIZE) as fh:
+                out = HashingWriter(fh)
+                yield out
+            if self.is_unchanged(fname, out):
+                os.remove(tmpname)
+                self.unchanged += 1
+                METRICS.count('output_files', state='unchanged')
+            else:
+                os.chmod(tmpname, default_file_mode())
+                os.replace(tmpname, fname)
+                self.written += 1
+                METRICS.count('output_files', state='written')
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmpname)
+            raise
+
+    def remove(self, fnames):
+        '''Remove outputs given relative to the render path, and directories left empty'''
+        root = os.path.realpath(self.path)
+        for fn in fnames:
+            fname = os.path.realpath(os.path.join(self.path, fn))
+            if not fname.startswith(root+os.sep):
+                logging.warning("Not removing stale output '{}' outside of render path".format(fn))
+                continue
+            logging.info("Removing stale output '{}'".format(fn))
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(fname)
+                self.removed += 1
+                METRICS.count('output_files', state='removed')
+            dirname = os.path.dirname(fname)
+            while dirname.startswith(root+os.sep):
+                try:
+                    os.rmdir(dirname)
+                except OSError:
+                    break
+                dirname = os.path.dirname(dirname)
+
+    def log_summary(self):
+        logging.info('Output files: {} written, {} unchanged, {} removed'.format(self.written, self.unchanged, self.removed))
+
+def bounded_map(pool, fn, items, ahead):
+    '''Like pool.map, but submitting at most ahead items beyond the one being consumed, bounding results held in memory'''
+    items = iter(items)
+    pending = collections.deque([pool.submit(fn, item) for item in itertools.islice(items, ahead)])
+    while pending:
+        future = pending.popleft()
+        for item in itertools.islice(items, 1):
+            pending.append(pool.submit(fn, item))
+        yield future.result()
+
+def run_helm(specs, args, state=None, sources=('-',)):
+    '''Render releases of specs, parsed from the spec files or directories sources. Releases of other spec
+    files recorded in the render path manifest are kept'''
+    if args.skip_helm:
+        return []
+
+    plan = plan_releases(specs, args)
+    if state:
+        own_state = False
+    else:
+        state = RunState(args)
+        own_state = True
+    state.begin()
+    try:
+        return render_releases(plan, args, state, sources)
+    finally:
+        state.finish()
+        if own_state:
+            state.close()
+
+def render_releases(plan, args, state, sources):
+    '''Render, diff or write the planned releases, returning images with --list-images'''
+    # The manifest records inputs and outputs of each release, for incremental re-rendering, and the
+    # index the resources of each release, for --diff
+    plan = [(resolve_chart_version(app, state.repo_index), outputs) for app, outputs in plan]
+    use_manifest = (args.output == 'file' or args.diff) and not args.list_images
+    old_manifest = load_manifest(args) if use_manifest else {}
+    manifest = {}
+    old_index = load_index(args) if use_manifest else {}
+    if args.diff and old_index is None:
+        logging.warning("No resource index in '{}', reporting all objects as added".format(args.render_path))
+    old_index = old_index or {}
+    # Index entries are spooled to disk as releases complete, and old entries dropped once used
+    index = IndexSpool(os.path.join(state.rundir, INDEX_NAME)) if use_manifest and not args.diff else None
+    diff = DiffReport(args) if args.diff else None
+    validator = SchemaValidator(schema_index(args)) if args.validate else None
+    writer = OutputWriter(args.render_path)
+    sources = [spec_source(s) for s in sources]
+    rids = set([release_id(app) for app, outputs in plan])
+    # Releases no longer in the spec files of this run. Releases of other spec files are kept
+    removed = set()
+    for rid, old in old_manifest.items():
+        if rid in rids:
+            continue
+        if manifest_owned(old, sources):
+            removed.add(rid)
         else:
-            secrets_ns = []
-        apps.append(res)
-        apps.append(res_ns)
-        apps.append(secrets)
-        apps.append(secrets_ns)
+            manifest[rid] = old
+            if index and rid in old_index:
+                index.add(rid, old_index.pop(rid))
+
+    import concurrent.futures
+    todo = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(args.jobs, 1)) as pool:
+        # Hashing fetches the chart for its digest
+        hashes = pool.map(lambda p: release_input_hash(p[0], args, state) if use_manifest else None, plan)
+        for (app, outputs), input_hash in zip(plan, hashes):
+            rid = release_id(app)
+            old = old_manifest.get(rid)
+            if args.incremental and old and old['input_hash'] == input_hash and \
+               all([os.path.exists(os.path.join(args.render_path, fn)) for fn in old['outputs']]):
+                logging.info('Release {} unchanged, skipping'.format(rid))
+                manifest[rid] = dict(old, source=app.get('source'))
+                if index and rid in old_index:
+                    index.add(rid, old_index.pop(rid))
+                continue
+            todo.append((app, outputs, input_hash))
+    if args.incremental and not args.diff:
+        for rid in sorted(removed):
+            logging.info('Release {} removed'.format(rid))
+            writer.remove(old_manifest[rid]['outputs'])
+        logging.info('Incremental render: {} releases to render, {} unchanged, {} removed'.format(len(todo), len(plan)-len(todo), len(removed)))
+    images = set()      # Images of all releases, with --list-images
+
+    def output_release(app, outputs, input_hash, buckets):
+        '''Validate, diff or write the resources of a release, recording it in the manifest and index'''
+        res, res_ns, secrets, secrets_ns = buckets
+        render_to = outputs['res']
+        render_w_ns_to = outputs['res_ns']
+        render_secrets_to = outputs['secrets']
+        render_secrets_w_ns_to = outputs['secrets_ns']
+        render_namespace_to = outputs['namespace']
 
         resource_list('Render-ready resources without explicit namespace', res)
         resource_list('Render-ready resources with explicit namespace', res_ns)
         resource_list('Render-ready secrets without explicit namespace', secrets)
         resource_list('Render-ready secrets with explicit namespace', secrets_ns)
 
-        if not args.list_images:
-            if args.output=='unwrap' or args.output=='file':
-                fnames = [render_to, render_w_ns_to, render_secrets_to, render_secrets_w_ns_to]
-                sources = [res, res_ns, secrets, secrets_ns]
-                for fname, src in zip(fnames, sources):
-                    if fname and len(src)>0:
-                        if args.output=='unwrap':
-                            fname = '-'
-                        with fopener(fname) as fh:
-                            for r in src:
-                                print(yaml.dump(r), file=fh)
-                                print('---', file=fh)
+        if validator:
+            with METRICS.phase('validate', app['rel_name']):
+                validator.validate(release_id(app), itertools.chain(res, res_ns, secrets, secrets_ns))
+
+        if args.list_images:
+            for b in buckets:
+                images.update(list_images(b))
+            return
+        rid = release_id(app)
+        files = []
+        if args.output != 'stdout' or args.diff:
+            fnames = [render_to, render_w_ns_to, render_secrets_to, render_secrets_w_ns_to]
+            sources = [res, res_ns, secrets, secrets_ns]
+            for fname, src in zip(fnames, sources):
+                if fname and len(src)>0:
+                    files.extend(output_shards(fname, src, args.layout))
+        if args.diff:
+            with METRICS.phase('diff', app['rel_name']):
+                old = old_index.pop(rid, {})
+                diff.release(rid, old, release_index(files, args.render_path, old), files)
+            return
+
+        written = []
+        with METRICS.phase('write', app['rel_name']):
+            for fname, src in files:
+                if args.output=='unwrap':
+                    with fopener('-') as fh:
+                        emit_resources(fh, src)
+                else:
+                    written.append(fname)
+                    with writer.open(fname) as fh:
+                        emit_resources(fh, src)
             if args.output=='stdout':
                 fname = '-'
+                if args.no_sort:
+                    items = itertools.chain(res, res_ns, secrets, secrets_ns)
+                else:
+                    items = heapq.merge(res, res_ns, secrets, secrets_ns, key=resource_sort_key)
                 with fopener(fname) as fh:
-                    print('apiVersion: config.kubernetes.io/v1', file=fh)
-                    print('kind: ResourceList', file=fh)
-                    #print('items:', file=fh)
-                    #  for r in src:
-                    print(yaml.dump({'items': res + res_ns + secrets + secrets_ns}), file=fh)
+                    emit_resource_list(fh, items)
             if args.add_namespace and render_namespace_to:
-                with fopener(render_namespace_to) as fh:
+                written.append(render_namespace_to)
+                with writer.open(render_namespace_to) as fh:
                     print(get_namespace_resource(args, app), file=fh)
-    return apps
+
+        if use_manifest:
+            index.add(rid, release_index(files, args.render_path, old_index.pop(rid, None)))
+            written = [os.path.relpath(fn, args.render_path) for fn in written]
+            if rid in old_manifest:
+                writer.remove([fn for fn in old_manifest[rid]['outputs'] if fn not in written])
+            chart, digest = state.fetched.get((app.get('repository'), app['chart'], str(app['version'])), (None, None))
+            manifest[rid] = {'input_hash': input_hash, 'chart': app['chart'], 'version': str(app['version']),
+                             'digest': digest, 'source': app.get('source'), 'outputs': written}
+
+    def render(task):
+        return task, helm_render(task[0], args, state)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(args.jobs, 1)) as pool:
+        # Releases are rendered concurrently, but results are consumed in spec order such that
+        # output is identical to a serial run
+        if args.jobs > 1:
+            results = bounded_map(pool, render, todo, args.jobs)
+        else:
+            results = map(render, todo)
+        for (app, outputs, input_hash), buckets in results:
+            output_release(app, outputs, input_hash, buckets)
+            # Drop the resources of a release before the next is rendered, such that memory use
+            # does not grow with the number of releases
+            del buckets
+
+    if args.diff:
+        for rid in old_index.keys():
+            if rid not in rids and manifest_owned(old_manifest.get(rid, {}), sources):
+                diff.release(rid, old_index[rid], {})
+        diff.log_summary()
+    elif use_manifest:
+        save_manifest(args, manifest)
+        index.save(args)
+        writer.log_summary()
+    if validator:
+        validator.log_summary()
+        if validator.counts['errors']:
+            raise ValidationError('{} resources failed schema validation'.format(validator.counts['invalid']))
+    return sorted(images)
 
 def do_helmsman(args):
     logging.debug('Helmsman spec files: {}'.format(args.helmsman))
+    specs = []
     for fn in args.helmsman:
-        specs = parse_helmsman(fn)
+        specs += parse_helmsman(fn)
+    if debug_enabled():
+        import pprint
         logging.debug('Parsed Helmsman spec: {}'.format(pprint.pformat(specs)))
-        if args.export_krm:
-            export_krmfmt(specs, args.export_krm)
-        return run_helm(specs, args)
+    if args.export_krm:
+        export_krmfmt(specs, args.export_krm)
+    return run_helm(specs, args, sources=args.helmsman)
 
 def do_flux(args):
-    logging.debug('Flux spec files: {}'.format(args.flux))
-    for fn in args.flux:
-        specs = parse_flux(fn)
+    logging.debug('Flux spec files: {}, directories: {}'.format(args.flux, args.flux_dir))
+    specs = parse_flux(args.flux, args.flux_dir)
+    if debug_enabled():
+        import pprint
         logging.debug('Parsed Flux spec: {}'.format(pprint.pformat(specs)))
-        return run_helm(specs, args)
+    return run_helm(specs, args, sources=args.flux+args.flux_dir)
 
 def do_krm(args):
     logging.debug('KRM spec files: {}'.format(args.krm))
+    specs = []
     for fn in args.krm:
-        specs,krm_version = parse_krm(fn)
+        krm_specs,krm_version = parse_krm(fn)
+        specs += krm_specs
+    if debug_enabled():
+        import pprint
         logging.debug('Parsed KRM spec: {}'.format(pprint.pformat(specs)))
-        if args.export_upgraded_krm:
-            export_krmfmt(specs, args.export_upgraded_krm)
-        return run_helm(specs, args)
+    if args.export_upgraded_krm:
+        export_krmfmt(specs, args.export_upgraded_krm)
+    return run_helm(specs, args, sources=args.krm)
+
+def scan_images(source):
+    '''Return (image, reference) of all containers in a YAML file. Source is (filename, display name, release)'''
+    fname, name, release = source
+    refs = []
+    with fopener_read(fname) as fh:
+        for doc in yaml2dict(fh, expand_env=False):
+            if not isinstance(doc, dict):
+                continue
+            if doc.get('kind') in ['ResourceList', 'List']:
+                items = doc.get('items') or []
+            else:
+                items = [doc]
+            for res in items:
+                meta = res.get('metadata') or {}
+                rel = release or (meta.get('labels') or {}).get('app.kubernetes.io/instance')
+                for container, image in resource_images(res):
+                    refs.append((image, {'release': rel, 'file': name, 'kind': res.get('kind'),
+                                         'namespace': meta.get('namespace'), 'name': meta.get('name'),
+                                         'container': container}))
+    return refs
+
+def do_images(args):
+    import concurrent.futures
+    import json
+    if args.images_file:
+        sources = [(fn, fn, None) for fn in args.images_file]
+    else:
+        if not os.path.isdir(args.render_path):
+            raise FileNotFoundError("Render path '{}' not found".format(args.render_path))
+        # Rendered files are attributed to releases using the manifest written when rendering
+        releases = {}
+        for rid, rel in load_manifest(args).items():
+            for fn in rel['outputs']:
+                releases[fn] = rid
+        sources = []
+        for root, dirs, files in os.walk(args.render_path):
+            dirs.sort()
+            for fn in sorted(files):
+                if fn.endswith('.yaml') or fn.endswith('.yml'):
+                    path = os.path.join(root, fn)
+                    name = os.path.relpath(path, args.render_path)
+                    sources.append((path, name, releases.get(name)))
+    logging.info('Scanning {} files for images'.format(len(sources)))
+
+    if args.jobs > 1 and len(sources) > 1 and '-' not in [fn for fn, _, _ in sources]:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            results = list(pool.map(scan_images, sources, chunksize=max(1, len(sources)//(args.jobs*4))))
+    else:
+        results = map(scan_images, sources)
+    images = {}
+    for refs in results:
+        for image, ref in refs:
+            images.setdefault(image, []).append(ref)
+
+    out = []
+    for image, refs in sorted(images.items()):
+        releases = collections.Counter([ref['release'] for ref in refs if ref['release']])
+        out.append({'image': image, 'count': len(refs), 'releases': dict(sorted(releases.items())),
+                    'references': refs})
+    with fopener(args.images_out) as fh:
+        json.dump({'images': out}, fh, indent=2)
+        fh.write('\n')
+
+def default_socket_path():
+    '''Socket in the user runtime directory, or in a directory of /tmp only accessible by the user'''
+    if os.environ.get('HELM2YAML_SOCKET'):
+        return os.environ['HELM2YAML_SOCKET']
+    rundir = os.environ.get('XDG_RUNTIME_DIR') or '/tmp/helm2yaml-{}'.format(os.getuid())
+    return os.path.join(rundir, 'helm2yaml.sock')
 
+def peer_uid(sock):
+    '''User id of the process at the other end of a Unix socket, None where not supported'''
+    import socket
+    import struct
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    pid, uid, gid = struct.unpack('3i', creds)
+    return uid
+
+# Server protocol frames are a 4 byte big-endian length followed by the payload. A request is a
+# JSON header frame (client working directory and environment) and a frame with the ResourceList.
+# The response is a JSON header frame (exit code and log output) and a frame with the function output.
+def send_frame(sock, data):
+    import struct
+    sock.sendall(struct.pack('>I', len(data)) + data)
+
+def recv_exact(sock, size):
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(min(size-len(buf), 1024*1024))
+        if not chunk:
+            raise EOFError('Connection closed')
+        buf += chunk
+    return bytes(buf)
+
+def recv_frame(sock):
+    import struct
+    size, = struct.unpack('>I', recv_exact(sock, 4))
+    return recv_exact(sock, size)
+
+@contextlib.contextmanager
+def client_environment(env):
+    '''Temporarily replace the process environment with the one of a client'''
+    saved = dict(os.environ)
+    os.environ.clear()
+    os.environ.update(env)
+    try:
+        yield
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+
+def krm_serve_request(args, state, header, payload):
+    '''Render a KRM function ResourceList request, returning exit code, log and output'''
+    out = io.StringIO()
+    log = io.StringIO()
+    handler = logging.StreamHandler(log)
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    logging.getLogger().addHandler(handler)
+    rc = 0
+    try:
+        with client_environment(header.get('env', {})), contextlib.redirect_stdout(out):
+            specs, krm_version = parse_krm_stream(io.StringIO(payload.decode('UTF-8')), header.get('cwd', '.'))
+            run_helm(specs, args, state)
+    except ValidationError as e:
+        logging.error(e)
+        rc = 1
+    except Exception:
+        logging.exception('Request failed')
+        rc = 1
+    finally:
+        logging.getLogger().removeHandler(handler)
+    return rc, log.getvalue(), out.getvalue()
+
+def do_krm_server(args):
+    '''Serve KRM function requests on a Unix socket, keeping charts and caches warm between requests'''
+    import json
+    import signal
+    import socket
+    import stat
+    args.output = 'stdout'
+    # Requests carry the client environment, only the user may connect
+    sockdir = os.path.dirname(os.path.abspath(args.socket))
+    with contextlib.suppress(FileExistsError):
+        os.mkdir(sockdir, 0o700)
+    st = os.lstat(sockdir)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid not in (os.getuid(), 0) or \
+       (st.st_mode & stat.S_IWOTH and not st.st_mode & stat.S_ISVTX):
+        raise OSError("Socket directory '{}' may be modified by other users".format(sockdir))
+    state = RunState(args)
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(args.socket)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o177)
+    try:
+        sock.bind(args.socket)
+    finally:
+        os.umask(umask)
+    os.chmod(args.socket, 0o600)
+    sock.listen(16)
+    logging.info("Serving KRM function requests on '{}'".format(args.socket))
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            conn, addr = sock.accept()
+            with conn:
+                uid = peer_uid(conn)
+                if uid is not None and uid != os.getuid():
+                    logging.warning('Rejecting request from user id {}'.format(uid))
+                    continue
+                try:
+                    header = json.loads(recv_frame(conn).decode('UTF-8'))
+                    payload = recv_frame(conn)
+                except (EOFError, ValueError) as e:
+                    logging.warning('Invalid request: {}'.format(e))
+                    continue
+                t0 = time.perf_counter()
+                rc, log, out = krm_serve_request(args, state, header, payload)
+                logging.info('Request served in {:.3f}s, exit code {}'.format(time.perf_counter()-t0, rc))
+                try:
+                    send_frame(conn, json.dumps({'rc': rc, 'log': log}).encode('UTF-8'))
+                    send_frame(conn, out.encode('UTF-8'))
+                except OSError as e:
+                    logging.warning('Failed to send response: {}'.format(e))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(args.socket)
+        state.close()
 
 def main():
     parser = argparse.ArgumentParser(description='Helm Update Frontend')
@@ -542,11 +2965,51 @@ def main():
                         help='Resource hook filter. Annotation values matching are removed from rendered output')
     parser.add_argument('--auto-api-upgrade', default=False, action='store_true',
                         help='Automatically upgrade API changes, e.g. the 1.16.0 API deprecations')
+    parser.add_argument('--api-upgrade-rules', default=[], action='append',
+                        help='File with additional API upgrade rules for --auto-api-upgrade, see examples/api-upgrade-rules.yaml')
     parser.add_argument('--no-sort', action='store_true', default=False,
-                        help='Sort resources by name')
+                        help='Keep resources in the order emitted by Helm. Default is to sort by kind in Helm install order, then by namespace and name')
+    parser.add_argument('--raw-passthrough', default=False, action='store_true',
+                        help='Emit resources as the text rendered by Helm, only parsing resources that are rewritten, e.g. by API upgrades')
     parser.add_argument('--local-chart-path', default='')
+    parser.add_argument('--list-chart-files', default=False, action='store_true',
+                        help='Log the files of extracted charts')
+    parser.add_argument('--cache-dir', default=os.environ.get('HELM2YAML_CACHE_DIR', ''),
+                        help='Persistent chart cache directory, may be shared between concurrent runs. Default from HELM2YAML_CACHE_DIR')
+    parser.add_argument('--cache-max-size', default=0, type=int,
+                        help='Evict least recently used charts and rendered output when cache exceeds this size in MiB. Zero means unlimited')
+    parser.add_argument('--cache-max-age', default=0, type=float,
+                        help='Evict charts and rendered output not used within this number of days. Zero means unlimited')
+    parser.add_argument('--no-render-cache', default=False, action='store_true',
+                        help='Bypass the cache of rendered chart output')
+    parser.add_argument('--purge-render-cache', default=False, action='store_true',
+                        help='Remove all cached rendered chart output of --cache-dir before rendering')
+    parser.add_argument('--no-repo-index', default=False, action='store_true',
+                        help='Always pull charts with helm. Default is to resolve charts of classic repositories using the repository index and download them directly')
+    parser.add_argument('--repo-index-ttl', default=300, type=float,
+                        help='Seconds a repository index is kept in the cache dir. Default 300')
     parser.add_argument('--skip-helm', default=False, action='store_true')
+    parser.add_argument('--incremental', default=False, action='store_true',
+                        help='Only render releases whose inputs changed since the last run, as recorded in the render path manifest')
+    parser.add_argument('-j', '--jobs', default=1, type=int,
+                        help='Number of releases to fetch and render, or files to scan for images, concurrently')
     parser.add_argument('-o', '--output', default='file', choices=['file', 'stdout', 'unwrap'])
+    parser.add_argument('--layout', default='release', choices=['release', 'kind', 'resource'],
+                        help='Output file layout, one file per release or a directory per release with a file per kind or resource')
+    parser.add_argument('--diff', default=False, action='store_true',
+                        help='Report objects added, changed and removed compared with the previous render in --render-path, without writing files')
+    parser.add_argument('--diff-fields', default=False, action='store_true',
+                        help='With --diff, also report changed fields of changed objects. Secret data is redacted')
+    parser.add_argument('--validate', default=False, action='store_true',
+                        help='Validate rendered resources against the schemas in --schema-dir and of CustomResourceDefinitions rendered. Fails on errors')
+    parser.add_argument('--schema-dir', default=os.environ.get('HELM2YAML_SCHEMA_DIR', 'schemas'),
+                        help='JSON schemas as laid out by kubernetes-json-schema, with a directory per Kubernetes version selected by --kube-version. Default from HELM2YAML_SCHEMA_DIR')
+    parser.add_argument('--timings', default=False, action='store_true',
+                        help='Log time spent per phase and resource counters')
+    parser.add_argument('--metrics-file', default=None,
+                        help='Write time spent per phase and release and resource counters to file')
+    parser.add_argument('--metrics-format', default='json', choices=['json', 'openmetrics'],
+                        help='Format of metrics file')
 
     subparsers = parser.add_subparsers()
     parser_helmsman = subparsers.add_parser('helmsman')
@@ -555,6 +3018,10 @@ def main():
     parser_fluxcd.set_defaults(func=do_flux)
     parser_krm = subparsers.add_parser('krm')
     parser_krm.set_defaults(func=do_krm)
+    parser_images = subparsers.add_parser('images', help='List images of rendered resources as JSON, without running Helm')
+    parser_images.set_defaults(func=do_images)
+    parser_krm_server = subparsers.add_parser('krm-server', help='Serve KRM function requests from krmclient.py')
+    parser_krm_server.set_defaults(func=do_krm_server)
     
     parser_helmsman.add_argument('-f', dest='helmsman', action='append', default=[])
     parser_helmsman.add_argument('--apply', default=False, dest='helmsman_apply', action='store_true', help='Dummy, for compatibility with Helmsman')
@@ -563,24 +3030,49 @@ def main():
     parser_helmsman.add_argument('--export-krm', help='Export KRM format spec filename')
 
     parser_fluxcd.add_argument('-f', dest='flux', action='append', default=[])
+    parser_fluxcd.add_argument('-d', dest='flux_dir', action='append', default=[],
+                               help='Directory to scan recursively for HelmRelease and HelmRepository objects')
 
     parser_krm.add_argument('-f', dest='krm', action='append', default=[])
     parser_krm.add_argument('--export-upgraded-krm', help='Export upgraded KRM format spec filename')
 
+    parser_images.add_argument('-f', dest='images_file', action='append', default=[],
+                               help='Resources or ResourceList file, - for stdin. Default is all YAML files in --render-path')
+    parser_images.add_argument('--out', dest='images_out', default='-', help='Output file, default stdout')
+
+    parser_krm_server.add_argument('--socket', default=default_socket_path(),
+                                   help='Unix socket path. Default from HELM2YAML_SOCKET')
+
     args = parser.parse_args()
     logging.basicConfig(stream=sys.stderr)
     logging.getLogger('').setLevel(getattr(logging, args.log_level))
 
-    logging.debug('Env variables: {}'.format(pprint.pformat(os.environ)))
+    if debug_enabled():
+        import pprint
+        logging.debug('Env variables: {}'.format(pprint.pformat(dict(os.environ))))
 
     if not hasattr(args, 'func'):
         parser.print_help()
         return -1
-    apps = args.func(args)
-    if args.list_images and apps:
-        for app in apps:
-            imgs = list_images(app)
-            print("\n".join(imgs))
+    if args.purge_render_cache and not args.cache_dir:
+        parser.error('--purge-render-cache requires --cache-dir')
+    if args.api_upgrade_rules and not args.auto_api_upgrade:
+        parser.error('--api-upgrade-rules requires --auto-api-upgrade')
+    status = 0
+    with METRICS.phase('total'):
+        try:
+            images = args.func(args)
+        except ValidationError as e:
+            logging.error(e)
+            images = None
+            status = 1
+    if args.list_images and images:
+        print("\n".join(images))
+    if args.timings:
+        METRICS.log_timings()
+    if args.metrics_file:
+        METRICS.write(args.metrics_file, args.metrics_format)
+    return status
 
 if __name__ == "__main__":
    sys.exit(main())
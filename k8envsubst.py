@@ -1,27 +1,117 @@
 #!/usr/bin/env python3
 
 import sys, os
+import argparse
 import string
-import yaml
 import logging
 import base64
+import re
 
-def main():
-    inp = open(0).read()
+# A line starting a new YAML document, e.g. '---' or '--- # comment'
+DOC_SEPARATOR = re.compile(r'---(\s|$)')
+SECRET_KIND = re.compile(r'''^kind:[ \t]*["']?Secret["']?[ \t]*(#.*)?$''', re.MULTILINE)
+DATA_KEY = re.compile(r'''^["']?data["']?[ \t]*:''')
+
+def substitute_b64(v64, env):
+    '''Substitute in a base64 encoded value, None if unchanged'''
+    v = base64.b64decode(v64).decode('UTF-8','ignore')
+    vrep = string.Template(v).safe_substitute(env)
+    if vrep == v:
+        return None
+    return base64.b64encode(vrep.encode('UTF-8')).decode('UTF-8','ignore')
+
+def data_block(doc):
+    '''Return start and end offset of the top-level data key and its value in the document text'''
+    start = None
+    pos = 0
+    for line in doc.splitlines(True):
+        if start is None:
+            if DATA_KEY.match(line):
+                start = pos
+        elif line.strip() and line[0] not in ' \t#':
+            return start, pos    # Next top-level key
+        pos += len(line)
+    return (start, pos) if start is not None else (0, 0)
+
+def substitute_secret(doc, env):
+    '''Substitute in base64 encoded Secret data, editing the document text in place when possible'''
+    import yaml
+    res = yaml.load(doc, Loader=getattr(yaml, 'CFullLoader', yaml.FullLoader))
+    if not isinstance(res, dict) or res.get('kind') != 'Secret' or not res.get('data'):
+        return doc
+    changed = {}
+    for k,v64 in res['data'].items():
+        if v64 not in changed:
+            changed[v64] = substitute_b64(v64, env)
+        if changed[v64] is not None:
+            res['data'][k] = changed[v64]
+    # Only values of the data mapping are replaced, other scalars may be equal, e.g. a checksum annotation
+    start, end = data_block(doc)
+    out = doc[start:end]
+    for v64, vrep64 in changed.items():
+        if vrep64 is None:
+            continue
+        # Replace the value as a whole scalar, in block or flow style
+        out, n = re.subn(r'''(?m)(:[ \t]*["']?)''' + re.escape(v64) + r'''(?=["']?[ \t]*([,}]|#.*|$))''',
+                         lambda m: m.group(1) + vrep64, out)
+        if n == 0:
+            # E.g. a value folded over several lines, fall back to re-writing the document
+            logging.debug('Secret data not found as plain scalar, re-writing document')
+            sep = doc.splitlines(True)[0] if DOC_SEPARATOR.match(doc) else ''
+            return sep + yaml.dump(res, default_flow_style=False)
+    return doc[:start] + out + doc[end:]
+
+def documents(fh):
+    '''Iterate over the YAML documents of a stream as text. A separator line is part of the document following it'''
+    doc = []
+    for line in fh:
+        if doc and DOC_SEPARATOR.match(line):
+            yield ''.join(doc)
+            doc = []
+        doc.append(line)
+    if doc:
+        yield ''.join(doc)
+
+def envsubst_stream(inp, out, env):
+    '''Substitute environment variables in documents as they are read. Only Secrets are parsed'''
+    ndocs = 0
+    for doc in documents(inp):
+        doc = string.Template(doc).safe_substitute(env)
+        if SECRET_KIND.search(doc):
+            doc = substitute_secret(doc, env)
+        out.write(doc)
+        ndocs += 1
+    logging.debug('Processed {} resource elements'.format(ndocs))
+
+def envsubst(inp, env):
+    import yaml
     resources = inp.split('---\n')
     logging.debug('Found {} resource elements'.format(len(resources)))
     patched_resources = []
     for res in resources:
-        res = string.Template(res).safe_substitute(os.environ)
+        res = string.Template(res).safe_substitute(env)
         res = yaml.load(res, Loader=yaml.FullLoader)
         if res:
             if 'kind' in res and 'data' in res and res['kind']=='Secret':
                 for k,v64 in res['data'].items():
                     v = base64.b64decode(v64)
-                    vrep = string.Template(v.decode('UTF-8','ignore')).safe_substitute(os.environ).encode('UTF-8')
+                    vrep = string.Template(v.decode('UTF-8','ignore')).safe_substitute(env).encode('UTF-8')
                     res['data'][k] = base64.b64encode(vrep).decode('UTF-8','ignore')
             patched_resources.append(yaml.dump(res, default_flow_style=False)) # FIXME, Use Kubernetes natural sort order
-    print('---\n'.join(patched_resources))
+    return '---\n'.join(patched_resources)
+
+def main():
+    parser = argparse.ArgumentParser(description='Substitute defined environment variables in Kubernetes resources, including base64 encoded Secret data')
+    parser.add_argument('--stream', default=False, action='store_true',
+                        help='Process documents as they are read. Only Secrets are parsed, formatting and comments are preserved')
+    args = parser.parse_args()
+
+    # Variables are expanded from a snapshot of the environment
+    env = dict(os.environ)
+    if args.stream:
+        envsubst_stream(sys.stdin, sys.stdout, env)
+    else:
+        print(envsubst(open(0).read(), env))
 
 if __name__ == "__main__":
    sys.exit(main())
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+# Thin KRM function client for 'helm2yaml.py krm-server'. Reads a ResourceList on stdin, forwards it
+# to the server together with the working directory and environment and writes the function output
+# to stdout. Usable e.g. as 'kpt fn eval --exec krmclient.py'.
+#
+# The framing and socket helpers below intentionally duplicate those of helm2yaml.py, such that the
+# client starts fast without importing helm2yaml.py and its dependencies. Keep them in sync.
+
+import sys, os
+import json
+import socket
+import struct
+
+def send_frame(sock, data):
+    sock.sendall(struct.pack('>I', len(data)) + data)
+
+def recv_exact(sock, size):
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(min(size-len(buf), 1024*1024))
+        if not chunk:
+            raise EOFError('Connection closed by server')
+        buf += chunk
+    return bytes(buf)
+
+def recv_frame(sock):
+    size, = struct.unpack('>I', recv_exact(sock, 4))
+    return recv_exact(sock, size)
+
+def default_socket_path():
+    if os.environ.get('HELM2YAML_SOCKET'):
+        return os.environ['HELM2YAML_SOCKET']
+    rundir = os.environ.get('XDG_RUNTIME_DIR') or '/tmp/helm2yaml-{}'.format(os.getuid())
+    return os.path.join(rundir, 'helm2yaml.sock')
+
+def peer_uid(sock):
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    pid, uid, gid = struct.unpack('3i', creds)
+    return uid
+
+def main():
+    path = default_socket_path()
+    if len(sys.argv) > 2 and sys.argv[1] == '--socket':
+        path = sys.argv[2]
+    payload = sys.stdin.buffer.read()
+    header = {'cwd': os.getcwd(), 'env': dict(os.environ)}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        # The environment may hold secrets, only send it to a server run by the same user
+        uid = peer_uid(sock)
+        if uid is not None and uid != os.getuid():
+            sys.exit("Server at '{}' runs as user id {}, refusing to send request".format(path, uid))
+        send_frame(sock, json.dumps(header).encode('UTF-8'))
+        send_frame(sock, payload)
+        resp = json.loads(recv_frame(sock).decode('UTF-8'))
+        out = recv_frame(sock)
+    sys.stderr.write(resp['log'])
+    sys.stdout.buffer.write(out)
+    return resp['rc']
+
+if __name__ == "__main__":
+   sys.exit(main())